@@ -1,114 +1,639 @@
-from typing import List
+from typing import TYPE_CHECKING, Counter, List, Tuple
+import collections
 import numpy as np
-from scipy.misc import logsumexp
-import copy
-import pprint as pp
+from scipy.special import logsumexp
+import timeit
 
+from logits_store import TopKFrames
 from n_gram_model import NGramModel
-from neuralmonkey.vocabulary import Vocabulary
+if TYPE_CHECKING:
+    from neuralmonkey.vocabulary import Vocabulary
 
-from hypothesis import Hypothesis, ExpandFunction
+from hypothesis import Hypothesis, PrefixTree, Beam, ROOT
 
 
-def empty_hypothesis() -> Hypothesis:
-    return Hypothesis([], 0.0, 0.0, None)
+def empty_beam(tree: PrefixTree = None) -> Beam:
+    if tree is None:
+        tree = PrefixTree()
 
-def expand_null(prev: Hypothesis, null_score: float) -> Hypothesis:
-    """Expand with null CTC token.
+    return Beam(tree, [ROOT], [0.0], [0.0], [0], [0], [0], [None])
 
-    CTC score gets updated, but the LM score and state remain the same.
+def log_softmax(logits_table):
+    return logits_table - logsumexp(logits_table, axis=1, keepdims=True)
+
+
+# columns of the feature matrix, the CTC score always has the weight 1
+FEATURES = ["ctc_score", "lm_score", "null_token_ratio", "null_trailing"]
+
+def feature_matrix(
+        ctc_score: np.ndarray,
+        lm_score: np.ndarray,
+        tokens_cnt: np.ndarray,
+        null_total: np.ndarray,
+        null_trailing: np.ndarray,
+        states_cnt: int) -> np.ndarray:
+    """Compute FEATURES for arrays of hypotheses, one row per hypothesis."""
+    k = 3
+    length = tokens_cnt + null_total
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ctc = np.where(length > 0, ctc_score / length, -1)
+        lm = np.where(tokens_cnt > 0, lm_score / tokens_cnt, -2)
+        null_token_ratio = np.where(
+            tokens_cnt > 0,
+            np.maximum(np.abs((null_total / tokens_cnt) - (2/1)) - 2, 0), 0)
+
+    trailing = np.maximum(null_trailing - (states_cnt / k), 0)
+
+    return np.stack([ctc, lm, null_token_ratio, trailing], axis=1)
+
+def beam_features(beam: Beam, states_cnt: int) -> np.ndarray:
+    return feature_matrix(beam.ctc_score, beam.lm_score, beam.tokens_cnt,
+                          beam.null_total, beam.null_trailing, states_cnt)
+
+def weight_vector(weights: dict) -> np.ndarray:
+    vector = np.zeros(len(FEATURES))
+    vector[FEATURES.index("ctc_score")] = 1.0
+
+    for key, value in weights.items():
+        if key not in FEATURES:
+            raise ValueError("Unknown feature: {}".format(key))
+        vector[FEATURES.index(key)] += value
+
+    return vector
+
+def score_features(features: np.ndarray, empty: np.ndarray,
+                   weight_vec: np.ndarray) -> np.ndarray:
+    scores = features.dot(weight_vec)
+    scores[empty] = -1e9
+    return scores
+
+def score_beam(beam: Beam, weight_vec: np.ndarray,
+               states_cnt: int) -> np.ndarray:
+    return score_features(beam_features(beam, states_cnt),
+                          (beam.tokens_cnt + beam.null_total) == 0,
+                          weight_vec)
+
+def expand_beam_by_null(beam: Beam, null_log_prob: float,
+                        count: int = 1) -> Beam:
+    """Expand every hypothesis by `count` null tokens at once.
+
+    No recombination is needed, all outputs stay unique.
     """
-    hyp = copy.deepcopy(prev)
-    hyp.expand_by_null(null_score)
-    return hyp
+    return Beam(beam.tree, beam.nodes, beam.ctc_score + null_log_prob,
+                beam.lm_score, beam.tokens_cnt, beam.null_total + count,
+                beam.null_trailing + count, beam.lm_states)
 
+def expand_beam(
+        beam: Beam,
+        null_log_prob: float,
+        candidates: np.ndarray,
+        token_log_probs: np.ndarray,
+        vocabulary: "Vocabulary",
+        lm: NGramModel,
+        expanded: np.ndarray = None) -> Beam:
+    """Expand every hypothesis by the null token and the candidate tokens.
 
-def log_softmax(logits_table):
-    return logits_table - logsumexp(logits_table, axis=1, keepdims=True)
+    `token_log_probs` are the log probabilities of the candidates. If the
+    boolean matrix `expanded` is given, the i-th hypothesis is expanded only
+    by the candidates in the True columns of its i-th row.
+
+    Expansions with the same output are recombined, the order in which this
+    happens is the same as when the hypotheses are expanded one by one. The
+    result is not pruned. The vocabulary must be set in the LM, see
+    `NGramModel.set_vocabulary`.
+    """
+    tree = beam.tree
 
+    # null expansions, the nodes in the beam are unique
+    nodes = beam.nodes.tolist()
+    ctc_score = (beam.ctc_score + null_log_prob).tolist()
+    lm_score = beam.lm_score.tolist()
+    tokens_cnt = beam.tokens_cnt.tolist()
+    null_total = (beam.null_total + 1).tolist()
+    null_trailing = (beam.null_trailing + 1).tolist()
+    lm_states = list(beam.lm_states)
 
-def score_hypothesis(hyp : Hypothesis, weights: dict, states_cnt: int):
-    if (len(hyp.tokens) + hyp.null_total) == 0 :
-        return -1e9
+    node_to_index = {node: i for i, node in enumerate(nodes)}
 
-    score = 0
+    words = [vocabulary.index_to_word[index] for index in candidates]
+    token_scores = np.asarray(token_log_probs).tolist()
+    candidates = np.asarray(candidates).tolist()
 
-    for key in weights.keys():
-        score += weights[key] * compute_feature(key, hyp, states_cnt)
+    for i in range(len(beam)):
+        parent = int(beam.nodes[i])
+        prev_ctc_score = float(beam.ctc_score[i])
+        prev_lm_score = float(beam.lm_score[i])
+        prev_tokens_cnt = int(beam.tokens_cnt[i])
+        prev_null_total = int(beam.null_total[i])
+        prev_lm_state = beam.lm_states[i]
 
-    score += compute_feature("ctc_score", hyp, states_cnt)
+        hyp_candidates = candidates
+        hyp_words = words
+        hyp_token_scores = token_scores
 
-    return score
+        if expanded is not None:
+            columns = expanded[i].nonzero()[0].tolist()
+            hyp_candidates = [candidates[j] for j in columns]
+            hyp_words = [words[j] for j in columns]
+            hyp_token_scores = [token_scores[j] for j in columns]
 
-def compute_feature(key: str, hyp: Hypothesis, states_cnt: int):
-    num_of_tokens = len(hyp.tokens)
-    k = 3
+        token_lm_scores, new_lm_states = lm.score_tokens(
+            prev_lm_state, hyp_candidates)
+
+        for word, token_score, token_lm_score, new_lm_state in zip(
+                hyp_words, hyp_token_scores, token_lm_scores, new_lm_states):
+            node = tree.child(parent, word)
+            new_ctc_score = prev_ctc_score + token_score
+            index = node_to_index.get(node)
+
+            if index is None:
+                node_to_index[node] = len(nodes)
+                nodes.append(node)
+                ctc_score.append(new_ctc_score)
+                lm_score.append(prev_lm_score + token_lm_score)
+                tokens_cnt.append(prev_tokens_cnt + 1)
+                null_total.append(prev_null_total)
+                null_trailing.append(0)
+                lm_states.append(new_lm_state)
+            else:
+                # recombination, the trailing nulls are kept as the maximum
+                ctc_score[index] = np.logaddexp(new_ctc_score, ctc_score[index])
+                lm_score[index] = prev_lm_score + token_lm_score
+                null_total[index] = prev_null_total
+                lm_states[index] = new_lm_state
+
+    return Beam(tree, nodes, ctc_score, lm_score, tokens_cnt,
+                null_total, null_trailing, lm_states)
+
+def bound_expansions(
+        beam: Beam,
+        null_log_prob: float,
+        candidates: np.ndarray,
+        token_log_probs: np.ndarray,
+        vocabulary: "Vocabulary",
+        lm_bounds: np.ndarray,
+        weight_vec: np.ndarray,
+        states_cnt: int,
+        beam_width: int) -> np.ndarray:
+    """Find the token expansions which can get into the pruned beam.
+
+    The score of every expansion is bounded from above with `lm_bounds`,
+    the upper bounds of the LM scores of the tokens, as the rest of the
+    features is known before the LM is queried. Expansions bounded below
+    the `beam_width`-th best score of the null expansions cannot get into
+    the beam. Only null expansions which no token expansion recombines
+    with are used, because the recombination changes their score.
 
-    if key == 'ctc_score':
-        return (hyp.ctc_score / (num_of_tokens + hyp.null_total) 
-                    if (num_of_tokens + hyp.null_total) else -1)
+    Returns a boolean matrix, hypotheses x candidates, see `expand_beam`.
+    """
+    keep = np.ones((len(beam), len(candidates)), dtype=bool)
+
+    # the LM score cannot be bounded if higher LM scores are worse
+    if len(beam) < beam_width or weight_vec[FEATURES.index("lm_score")] < 0:
+        return keep
+
+    tree = beam.tree
+    nodes = beam.nodes.tolist()
+    node_to_index = {node: i for i, node in enumerate(nodes)}
+    candidate_to_column = {vocabulary.index_to_word[index]: j
+                           for j, index in enumerate(candidates)}
+
+    # expansions which recombine with a hypothesis in the beam
+    fixed = np.ones(len(beam), dtype=bool)
+    for i, node in enumerate(nodes):
+        parent_index = node_to_index.get(tree.parents[node])
+        column = candidate_to_column.get(tree.tokens[node])
+        if parent_index is not None and column is not None:
+            fixed[i] = False
+
+    null_scores = score_features(
+        feature_matrix(beam.ctc_score + null_log_prob, beam.lm_score,
+                       beam.tokens_cnt, beam.null_total + 1,
+                       beam.null_trailing + 1, states_cnt),
+        (beam.tokens_cnt + beam.null_total + 1) == 0, weight_vec)[fixed]
+
+    if len(null_scores) < beam_width:
+        return keep
+
+    threshold = np.partition(-null_scores, beam_width - 1)[beam_width - 1]
+
+    rows, columns = len(beam), len(candidates)
+    bound_scores = feature_matrix(
+        (beam.ctc_score[:, np.newaxis]
+         + np.asarray(token_log_probs)[np.newaxis, :]).ravel(),
+        (beam.lm_score[:, np.newaxis]
+         + lm_bounds[np.asarray(candidates)][np.newaxis, :]).ravel(),
+        np.repeat(beam.tokens_cnt + 1, columns),
+        np.repeat(beam.null_total, columns),
+        np.zeros(rows * columns, dtype=np.int64),
+        states_cnt).dot(weight_vec).reshape(rows, columns)
+
+    # the slack covers rounding differences of the two score computations
+    keep = bound_scores >= -threshold - 1e-9
+
+    for i, node in enumerate(nodes):
+        if not fixed[i]:
+            keep[node_to_index[tree.parents[node]],
+                 candidate_to_column[tree.tokens[node]]] = True
+
+    return keep
+
+def _mass_counts(sorted_log_probs: np.ndarray, candidate_mass: float,
+                 null_log_probs: np.ndarray) -> np.ndarray:
+    """Count the candidates needed to cover the mass in every frame."""
+    covered = np.cumsum(np.exp(sorted_log_probs), axis=1)
+    if null_log_probs is not None:
+        covered += np.exp(null_log_probs)[:, np.newaxis]
+    return np.minimum((covered < candidate_mass).sum(axis=1) + 1,
+                      sorted_log_probs.shape[1])
+
+def candidate_table(token_log_prob_table: np.ndarray, beam_width: int,
+                    candidate_mass: float = None,
+                    null_log_probs: np.ndarray = None) -> List[np.ndarray]:
+    """Select the candidate tokens of all frames at once.
+
+    Without `candidate_mass`, every frame gets its 2 * beam_width most
+    probable tokens, in no particular order. Otherwise, only the most
+    probable of them are kept, as many as needed for them and the null token
+    to cover `candidate_mass` of the probability of the frame, at least one.
+    """
+    width = 2 * beam_width
+    top = np.argpartition(-token_log_prob_table, width, axis=1)[:, :width]
+
+    if candidate_mass is None:
+        return list(top)
+
+    rows = np.arange(len(top))[:, np.newaxis]
+    top_log_probs = token_log_prob_table[rows, top]
+    order = np.argsort(-top_log_probs, axis=1)
+    top = top[rows, order]
+    counts = _mass_counts(top_log_probs[rows, order], candidate_mass,
+                          null_log_probs)
+
+    return [row[:count] for row, count in zip(top, counts)]
+
+def top_k_candidates(
+        indices: np.ndarray,
+        log_probs: np.ndarray,
+        beam_width: int,
+        candidate_mass: float = None,
+        null_log_probs: np.ndarray = None
+    ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """Select the candidates from tokens already sorted by probability.
+
+    Same as `candidate_table`, but for the best tokens of every frame
+    selected in the model, see `TopKFrames`. Returns the candidates and
+    their log probabilities.
+    """
+    width = 2 * beam_width
+    indices = indices[:, :width]
+    log_probs = log_probs[:, :width]
+
+    if candidate_mass is None:
+        return list(indices), list(log_probs)
+
+    counts = _mass_counts(log_probs, candidate_mass, null_log_probs)
+
+    return ([row[:count] for row, count in zip(indices, counts)],
+            [row[:count] for row, count in zip(log_probs, counts)])
 
-    elif key == 'lm_score':
-        return hyp.lm_score / num_of_tokens if num_of_tokens else -2
+def prune_beam(beam: Beam, scores: np.ndarray, beam_width: int) -> Beam:
+    if len(beam) <= beam_width:
+        return beam
 
-    elif key == 'null_token_ratio':
-        return (max(abs((hyp.null_total/num_of_tokens) - (2/1))-2,0) 
-                    if num_of_tokens else 0)
+    best_hyp_indices = np.argpartition(-scores, beam_width)[:beam_width]
+    return beam.select(best_hyp_indices)
+
+def prune_beam_by_margin(beam: Beam, scores: np.ndarray, beam_width: int,
+                         margin: float, min_width: int = 1) -> Beam:
+    """Keep the hypotheses scoring at most `margin` below the best one.
+
+    At most `beam_width` and at least `min_width` best hypotheses are kept
+    regardless of the margin.
+    """
+    width = int(np.count_nonzero(scores >= scores.max() - margin))
+    return prune_beam(beam, scores, min(max(width, min_width), beam_width))
 
-    elif key == 'null_trailing':
-        return max(hyp.null_trailing-(states_cnt/k),0)
+class TimedLM(object):
+    """Language model wrapper which counts the LM calls and their time."""
+
+    def __init__(self, lm: NGramModel, stats: Counter) -> None:
+        self.lm = lm
+        self.stats = stats
+
+    def start_sentence(self) -> None:
+        self.lm.start_sentence()
+
+    def score_tokens(self, prev_state, indices):
+        t1 = timeit.default_timer()
+        result = self.lm.score_tokens(prev_state, indices)
+        self.stats["lm_time"] += timeit.default_timer() - t1
+        self.stats["lm_calls"] += len(indices)
+        return result
+
+class StreamingDecoder(object):
+    """Beam search over logits which arrive in chunks of frames.
+
+    The beam is kept between the calls of `feed`. The null-trailing
+    feature depends on the number of frames of the whole input, which is
+    only known in `finish`; until then the beam is pruned as if the input
+    ended with the frames seen so far, unless `frames` gives the expected
+    length in advance. Feeding the whole input at once gives the same
+    result as `decode_beam`.
+
+    If `blank_threshold` is set, frames where the probability of the null
+    token exceeds it are not expanded by any other token. Consecutive
+    frames like this are added to the beam at once. If `stats` is given,
+    the numbers of all and skipped frames are added to it. If
+    `candidate_mass` is set, frames are expanded only by the candidates
+    covering this probability mass, see `candidate_table`. If `lm_bound`
+    is set, token expansions which cannot get into the beam even with the
+    LM score bounded by `NGramModel.token_bounds` are not scored by the LM,
+    see `bound_expansions`; their number is added to `stats`.
+
+    If `beam_margin` is set, hypotheses scoring more than the margin below
+    the best one are pruned as well, so `beam_width` is only the largest
+    beam and `min_beam` the smallest one. The numbers of decoded frames
+    with every beam size after pruning are then added to `stats` as
+    `beam_size_N`.
+
+    With `profile`, `stats` also gets the time spent in the individual
+    steps of the search, the numbers of LM calls, expansions and
+    recombinations, and the summed beam sizes before and after pruning.
+    The unprofiled search does not measure anything per frame.
+    """
+
+    def __init__(self,
+                 beam_width: int,
+                 vocabulary: "Vocabulary",
+                 lm: NGramModel,
+                 weights: dict,
+                 blank_threshold: float = None,
+                 candidate_mass: float = None,
+                 lm_bound: str = None,
+                 beam_margin: float = None,
+                 min_beam: int = 1,
+                 frames: int = None,
+                 stats: Counter = None,
+                 profile: bool = False) -> None:
+        assert beam_width >= 1
+
+        if (profile or lm_bound or beam_margin is not None) and stats is None:
+            stats = collections.Counter()
+
+        self.beam_width = beam_width
+        self.vocabulary = vocabulary
+        self.lm = lm
+        self.weight_vec = weight_vector(weights)
+        self.blank_threshold = blank_threshold
+        self.candidate_mass = candidate_mass
+        self.beam_margin = beam_margin
+        self.min_beam = min_beam
+        self.frames = frames
+        self.stats = stats
+        self.profile = profile
+
+        lm.set_vocabulary(vocabulary)
+        self.lm_bounds = lm.token_bounds(lm_bound) if lm_bound else None
+
+        if profile:
+            self.lm = TimedLM(lm, stats)
+            self._step = self._profiled_step
+
+        self.beam = empty_beam(PrefixTree())
+        self.frames_seen = 0
+        self.finished = False
+
+        # null-only frames not yet added to the beam
+        self.skipped_log_prob = 0.0
+        self.skipped_cnt = 0
+
+        lm.start_sentence()
+
+    def _states_cnt(self) -> int:
+        if self.frames is not None:
+            return max(self.frames, self.frames_seen)
+        return self.frames_seen
+
+    def _current_beam(self) -> Beam:
+        if self.skipped_cnt:
+            return expand_beam_by_null(
+                self.beam, self.skipped_log_prob, self.skipped_cnt)
+        return self.beam
+
+    def _bound_expansions(self, beam: Beam, null_log_prob: float,
+                          candidates: np.ndarray, token_log_probs: np.ndarray,
+                          states_cnt: int) -> np.ndarray:
+        if self.lm_bounds is None:
+            return None
+
+        expanded = bound_expansions(
+            beam, null_log_prob, candidates, token_log_probs,
+            self.vocabulary, self.lm_bounds, self.weight_vec, states_cnt,
+            self.beam_width)
+        self.stats["bound_pruned"] += expanded.size - int(expanded.sum())
+        return expanded
+
+    def _step(self, beam: Beam, null_log_prob: float, candidates: np.ndarray,
+              token_log_probs: np.ndarray, states_cnt: int) -> Beam:
+        expanded = self._bound_expansions(
+            beam, null_log_prob, candidates, token_log_probs, states_cnt)
+        beam = expand_beam(beam, null_log_prob, candidates, token_log_probs,
+                           self.vocabulary, self.lm, expanded)
+        scores = score_beam(beam, self.weight_vec, states_cnt)
+        return self._prune(beam, scores)
+
+    def _prune(self, beam: Beam, scores: np.ndarray) -> Beam:
+        if self.beam_margin is None:
+            return prune_beam(beam, scores, self.beam_width)
+
+        beam = prune_beam_by_margin(beam, scores, self.beam_width,
+                                    self.beam_margin, self.min_beam)
+        self.stats["beam_size_{}".format(len(beam))] += 1
+        return beam
+
+    def _profiled_step(self, beam: Beam, null_log_prob: float,
+                       candidates: np.ndarray, token_log_probs: np.ndarray,
+                       states_cnt: int) -> Beam:
+        stats = self.stats
+
+        t0 = timeit.default_timer()
+        expanded = self._bound_expansions(
+            beam, null_log_prob, candidates, token_log_probs, states_cnt)
+        t1 = timeit.default_timer()
+        new_beam = expand_beam(beam, null_log_prob, candidates,
+                               token_log_probs, self.vocabulary, self.lm,
+                               expanded)
+        t2 = timeit.default_timer()
+        scores = score_beam(new_beam, self.weight_vec, states_cnt)
+        t3 = timeit.default_timer()
+        pruned_beam = self._prune(new_beam, scores)
+        t4 = timeit.default_timer()
+
+        if expanded is None:
+            token_expansions = len(beam) * len(candidates)
+        else:
+            token_expansions = int(expanded.sum())
+
+        stats["bound_time"] += t1 - t0
+        stats["expand_time"] += t2 - t1
+        stats["score_time"] += t3 - t2
+        stats["prune_time"] += t4 - t3
+        stats["decoded_frames"] += 1
+        stats["token_expansions"] += token_expansions
+        stats["null_expansions"] += len(beam)
+        stats["recombinations"] += (
+            token_expansions - (len(new_beam) - len(beam)))
+        stats["expanded_hyps"] += len(new_beam)
+        stats["pruned_hyps"] += len(pruned_beam)
+
+        return pruned_beam
+
+    def _expanded_frames(self, null_log_probs: np.ndarray) -> np.ndarray:
+        """Return the frames which are expanded by other than null tokens."""
+        if self.blank_threshold is None:
+            return np.arange(len(null_log_probs))
+        return (null_log_probs <= np.log(self.blank_threshold)).nonzero()[0]
+
+    def feed(self, logits_chunk: np.ndarray) -> None:
+        """Extend the search by the next frames, time x vocabulary."""
+        log_prob_table = log_softmax(logits_chunk)
+        null_log_probs = log_prob_table[:, -1]
+        expanded = self._expanded_frames(null_log_probs)
+
+        t1 = timeit.default_timer()
+        candidates = candidate_table(
+            log_prob_table[expanded, :-1], self.beam_width,
+            self.candidate_mass, null_log_probs[expanded])
+        token_log_probs = [log_prob_table[time, frame_candidates]
+                           for time, frame_candidates
+                           in zip(expanded, candidates)]
+        if self.profile:
+            self.stats["candidates_time"] += timeit.default_timer() - t1
+
+        self._search(null_log_probs, expanded, candidates, token_log_probs)
+
+    def feed_top_k(self, frames: TopKFrames) -> None:
+        """Extend the search by the next frames with preselected tokens."""
+        null_log_probs = frames.null_log_probs
+        expanded = self._expanded_frames(null_log_probs)
+
+        t1 = timeit.default_timer()
+        candidates, token_log_probs = top_k_candidates(
+            frames.indices[expanded], frames.log_probs[expanded],
+            self.beam_width, self.candidate_mass, null_log_probs[expanded])
+        if self.profile:
+            self.stats["candidates_time"] += timeit.default_timer() - t1
+
+        self._search(null_log_probs, expanded, candidates, token_log_probs)
+
+    def _search(self, null_log_probs: np.ndarray, expanded: np.ndarray,
+                candidates: List[np.ndarray],
+                token_log_probs: List[np.ndarray]) -> None:
+        if self.finished:
+            raise ValueError("The decoder is already finished.")
+
+        self.frames_seen += len(null_log_probs)
+        states_cnt = self._states_cnt()
+
+        null_skipped = np.ones(len(null_log_probs), dtype=bool)
+        null_skipped[expanded] = False
+        frames = zip(candidates, token_log_probs)
+
+        beam = self.beam
+
+        for time, null_log_prob in enumerate(null_log_probs):
+            if null_skipped[time]:
+                self.skipped_log_prob += null_log_prob
+                self.skipped_cnt += 1
+                continue
+
+            if self.skipped_cnt:
+                beam = expand_beam_by_null(
+                    beam, self.skipped_log_prob, self.skipped_cnt)
+                self.skipped_log_prob = 0.0
+                self.skipped_cnt = 0
+
+            frame_candidates, frame_log_probs = next(frames)
+            beam = self._step(beam, null_log_prob, frame_candidates,
+                              frame_log_probs, states_cnt)
+
+        self.beam = beam
+
+        if self.stats is not None:
+            self.stats["frames"] += len(null_log_probs)
+            self.stats["skipped_frames"] += int(null_skipped.sum())
+
+    def best(self) -> Hypothesis:
+        """Return the best hypothesis of the frames seen so far."""
+        beam = self._current_beam()
+        scores = score_beam(beam, self.weight_vec, self._states_cnt())
+        return beam.hypothesis(int(np.argmax(scores)))
+
+    def committed(self) -> List[str]:
+        """Return the output prefix shared by the whole beam.
+
+        All future hypotheses extend one in the beam, so the prefix no
+        longer changes.
+        """
+        tree = self.beam.tree
+        return tree.token_list(tree.common_ancestor(self.beam.nodes.tolist()))
+
+    def finish(self) -> Hypothesis:
+        """Rescore the beam with the true number of frames and return the
+        best hypothesis."""
+        beam = self._current_beam()
+        self.finished = True
+
+        scores = score_beam(beam, self.weight_vec, self.frames_seen)
+        return beam.hypothesis(int(np.argmax(scores)))
+
+    def n_best(self) -> List[Tuple[List[str], np.ndarray]]:
+        """Return the hypotheses of the finished beam with their FEATURES,
+        the best one first."""
+        beam = self._current_beam()
+        features = beam_features(beam, self.frames_seen)
+        scores = score_features(
+            features, (beam.tokens_cnt + beam.null_total) == 0,
+            self.weight_vec)
+
+        return [(beam.hypothesis(i).tokens, features[i])
+                for i in np.argsort(-scores, kind="mergesort")]
 
 def decode_beam(
         logits_table: np.ndarray,
         beam_width: int,
-        vocabulary: Vocabulary,
+        vocabulary: "Vocabulary",
         lm: NGramModel,
-        weights: dict) -> List[str]:
-    assert beam_width >= 1
-    
-    log_prob_table = log_softmax(logits_table)
-
-    hypotheses = [empty_hypothesis()]
-    states_cnt = len(log_prob_table)
-
-    for time, log_probs in enumerate(log_prob_table):
-        null_log_prob = log_probs[-1]
-        token_log_probs = log_probs[:-1]
-        new_hypotheses = []
-
-        str_to_hyp = {}
-
-        for hyp in hypotheses:
-            expanded = expand_null(hyp, null_log_prob)
-            str_to_hyp[" ".join(expanded.tokens)] = (
-                expanded, len(new_hypotheses))
-            new_hypotheses.append(expanded)
-
-        best_tokens = np.argpartition(
-            -token_log_probs, 2 * beam_width)[:2 * beam_width]
-        best_scores = token_log_probs[best_tokens]
-
-        for hyp in hypotheses:
-            for index, score in zip(best_tokens, best_scores):
-                token = vocabulary.index_to_word[index]
-                expanded = lm.expand_token(hyp, token, score)
-                score = score_hypothesis(expanded, weights, states_cnt)
-                hyp_str = " ".join(expanded.tokens)
-                if hyp_str in str_to_hyp:
-                    orig_hyp, index = str_to_hyp[hyp_str]
-                    expanded.recombine_with(orig_hyp)
-                    new_hypotheses[index] = expanded
-                    str_to_hyp[hyp_str] = (expanded, index)
-                else:
-                    str_to_hyp[hyp_str] = (expanded, len(new_hypotheses))
-                    new_hypotheses.append(expanded)
-
-        new_scores = np.array([score_hypothesis(h, weights, states_cnt) 
-                                        for h in new_hypotheses])
-        best_hyp_indices = np.argpartition(
-            -new_scores, beam_width)[:beam_width]
-
-        hypotheses = [new_hypotheses[i] for i in best_hyp_indices]
-
-    best = max(hypotheses, key=lambda h: score_hypothesis(h, weights, states_cnt))
-    return best
+        weights: dict,
+        blank_threshold: float = None,
+        candidate_mass: float = None,
+        lm_bound: str = None,
+        beam_margin: float = None,
+        min_beam: int = 1,
+        stats: Counter = None,
+        profile: bool = False,
+        n_best: list = None) -> Hypothesis:
+    """Find the best hypothesis for the logits using beam search.
+
+    The logits can also be given as `TopKFrames`. See `StreamingDecoder` for
+    the optional arguments. If `n_best` is given, it is extended by the
+    final beam, see `StreamingDecoder.n_best`.
+    """
+    decoder = StreamingDecoder(beam_width, vocabulary, lm, weights,
+                               blank_threshold=blank_threshold,
+                               candidate_mass=candidate_mass,
+                               lm_bound=lm_bound,
+                               beam_margin=beam_margin, min_beam=min_beam,
+                               stats=stats,
+                               profile=profile)
+    if isinstance(logits_table, TopKFrames):
+        decoder.feed_top_k(logits_table)
+    else:
+        decoder.feed(logits_table)
+    best_hyp = decoder.finish()
+
+    if n_best is not None:
+        n_best.extend(decoder.n_best())
+    return best_hyp
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""Benchmark the decoder on synthetic logits with a toy language model.
+
+Neither TensorFlow nor a trained model is needed. Sentences are generated
+with mostly blank frames and a random token peaking in the remaining ones,
+the planted tokens serve as the training targets. The toy bigram ARPA
+model covers the synthetic vocabulary.
+
+`decode_beam`, `train_weights` and `ctc_path` are timed for every
+combination of the vocabulary size, sentence length and beam width, and
+the timings are written as JSON. The best hypotheses, their scores and the
+trained weights can be recorded as golden outputs and later checked, so
+that a faster decoder can be shown to give the same results. The pruning
+options of the decoder are not part of the settings compared by the check,
+so the outputs of an exact option such as `--lm-bound zero` can be checked
+against outputs recorded without it.
+"""
+
+from typing import Dict, List, Tuple
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+from beam_search import decode_beam, log_softmax
+from logits_store import StoredVocabulary, TopKFrames
+from n_gram_model import NGramModel
+from train_beam_search import ctc_path, train_weights
+
+
+WEIGHTS = {"lm_score": 0.5, "null_trailing": -0.3, "null_token_ratio": -0.1}
+
+
+def synthetic_words(vocab_size: int) -> List[str]:
+    return ["w{}".format(i) for i in range(vocab_size)]
+
+
+def synthetic_sentence(random: np.random.RandomState, vocab_size: int,
+                       length: int, blank_ratio: float
+                      ) -> Tuple[np.ndarray, List[str]]:
+    """Generate logits of one sentence and the tokens planted in them."""
+    logits = random.randn(length, vocab_size + 1) * 2
+    blank = random.rand(length) < blank_ratio
+    logits[blank, -1] += 8
+
+    token_frames = (~blank).nonzero()[0]
+    tokens = random.randint(vocab_size, size=len(token_frames))
+    logits[token_frames, tokens] += 6
+
+    return logits.astype(np.float32), ["w{}".format(t) for t in tokens]
+
+
+def top_k_frames(logits: np.ndarray, k: int) -> TopKFrames:
+    """Select the k best tokens of every frame like the graph of
+    `ctc_model.load_experiment` with `top_k`."""
+    log_probs = log_softmax(logits)
+    # ties are broken by the lower index, as by tf.nn.top_k
+    indices = np.argsort(-log_probs[:, :-1], axis=1, kind="mergesort")[:, :k]
+    rows = np.arange(len(log_probs))[:, np.newaxis]
+    return TopKFrames(indices, log_probs[rows, indices], log_probs[:, -1])
+
+
+def write_arpa(path: str, words: List[str], random: np.random.RandomState,
+               successors: int = 5) -> None:
+    """Write a bigram ARPA model with a few random successors per word."""
+    unigrams = [(-random.uniform(1, 3), word)
+                for word in words + ["<s>", "</s>", "<unk>"]]
+    bigrams = sorted({(words[i], words[j])
+                      for i in range(len(words))
+                      for j in random.randint(len(words), size=successors)})
+
+    with open(path, "w") as f:
+        f.write("\\data\\\nngram 1={}\nngram 2={}\n\n\\1-grams:\n".format(
+            len(unigrams), len(bigrams)))
+        for prob, word in unigrams:
+            f.write("{:.4f}\t{}\t-0.3000\n".format(prob, word))
+        f.write("\n\\2-grams:\n")
+        for first, second in bigrams:
+            f.write("{:.4f}\t{} {}\n".format(
+                -random.uniform(0.1, 1), first, second))
+        f.write("\n\\end\\\n")
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(sentences: List[Tuple[np.ndarray, List[str]]], vocabulary,
+             lm: NGramModel, beam: int, repeat: int, decode_options: dict,
+             top_k: bool = False) -> Tuple[Dict[str, float], dict]:
+    """Time the functions on the sentences, return timings and outputs.
+
+    `decode_options` are passed to `decode_beam`. With `top_k`, the decoder
+    gets only the 2 * beam best tokens of every frame.
+    """
+    timings = {}
+    outputs = {}
+
+    def timed(name, function):
+        best = None
+        for _ in range(repeat):
+            t1 = timeit.default_timer()
+            result = function()
+            t2 = timeit.default_timer()
+            best = t2 - t1 if best is None else min(best, t2 - t1)
+        timings[name] = best
+        return result
+
+    decoded = [top_k_frames(logits, 2 * beam) if top_k else logits
+               for logits, _ in sentences]
+    hyps = timed("decode_beam", lambda: [
+        decode_beam(logits, beam, vocabulary, lm, WEIGHTS, **decode_options)
+        for logits in decoded])
+    outputs["decode_beam"] = [
+        {"tokens": hyp.tokens, "ctc_score": float(hyp.ctc_score),
+         "lm_score": float(hyp.lm_score)} for hyp in hyps]
+
+    def train():
+        weights = dict(WEIGHTS)
+        for logits, target in sentences:
+            train_weights(logits, beam, vocabulary, target, weights, lm)
+        return weights
+
+    outputs["train_weights"] = timed("train_weights", train)
+
+    return timings, outputs
+
+
+def run_alignment(sentences: List[Tuple[np.ndarray, List[str]]], vocabulary,
+                  lm: NGramModel, repeat: int) -> Tuple[float, list]:
+    log_prob_tables = [log_softmax(logits) for logits, _ in sentences]
+    best = None
+
+    for _ in range(repeat):
+        t1 = timeit.default_timer()
+        paths = [ctc_path(target, table, WEIGHTS, lm, vocabulary)
+                 for table, (_, target) in zip(log_prob_tables, sentences)]
+        t2 = timeit.default_timer()
+        best = t2 - t1 if best is None else min(best, t2 - t1)
+
+    return best, [None if path is None else float(path[-1].ctc_score)
+                  for path in paths]
+
+
+def compare(golden, outputs, tolerance: float, path: str = "") -> List[str]:
+    """List the differences between the golden and the current outputs."""
+    if isinstance(golden, dict) and isinstance(outputs, dict):
+        if set(golden) != set(outputs):
+            return ["{}: keys {} != {}".format(
+                path, sorted(golden), sorted(outputs))]
+        return [diff for key in sorted(golden) for diff in compare(
+            golden[key], outputs[key], tolerance, "{}/{}".format(path, key))]
+
+    if isinstance(golden, list) and isinstance(outputs, list):
+        if len(golden) != len(outputs):
+            return ["{}: length {} != {}".format(
+                path, len(golden), len(outputs))]
+        return [diff for i, (gold, out) in enumerate(zip(golden, outputs))
+                for diff in compare(gold, out, tolerance,
+                                    "{}/{}".format(path, i))]
+
+    if (isinstance(golden, float) and isinstance(outputs, float)
+            and abs(golden - outputs) <= tolerance):
+        return []
+
+    if golden != outputs:
+        return ["{}: {!r} != {!r}".format(path, golden, outputs)]
+
+    return []
+
+
+def int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--beams", type=int_list, default=[1, 5, 10, 20],
+                        help="Comma-separated beam widths.")
+    parser.add_argument("--vocab-sizes", type=int_list,
+                        default=[100, 1000, 5000],
+                        help="Comma-separated vocabulary sizes.")
+    parser.add_argument("--lengths", type=int_list, default=[20, 50, 100],
+                        help="Comma-separated sentence lengths in frames.")
+    parser.add_argument("--sentences", type=int, default=5,
+                        help="Number of sentences of every length.")
+    parser.add_argument("--blank-ratio", type=float, default=0.6,
+                        help="Share of the frames dominated by the blank.")
+    parser.add_argument("--blank-threshold", type=float, default=None,
+                        help="Blank threshold passed to decode_beam.")
+    parser.add_argument("--candidate-mass", type=float, default=None,
+                        help="Candidate mass passed to decode_beam.")
+    parser.add_argument("--lm-bound", type=str, default=None,
+                        choices=["zero", "unigram"],
+                        help="LM bound passed to decode_beam.")
+    parser.add_argument("--beam-margin", type=float, default=None,
+                        help="Beam margin passed to decode_beam.")
+    parser.add_argument("--min-beam", type=int, default=1,
+                        help="Smallest beam kept with --beam-margin.")
+    parser.add_argument("--top-k", action="store_true",
+                        help="Decode only the 2 * beam best tokens of every "
+                        "frame, like run_model.py --top-k-in-graph.")
+    parser.add_argument("--lm-cache-size", type=int, default=0,
+                        help="Number of LM transitions kept in the cache.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Report the fastest of this many runs.")
+    parser.add_argument("--seed", type=int, default=1234,
+                        help="Seed of the synthetic data.")
+    parser.add_argument("--work-dir", type=str, default=None,
+                        help="Directory for the toy LMs (default: temporary).")
+    parser.add_argument("--out", type=str, default=None,
+                        help="Path to the JSON timings (default: stdout).")
+    parser.add_argument("--record", type=str, default=None,
+                        help="Save the outputs as golden outputs to this path.")
+    parser.add_argument("--check", type=str, default=None,
+                        help="Compare the outputs with golden outputs from "
+                        "this path, exit with 1 if they differ.")
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="Allowed absolute difference of the scores.")
+    args = parser.parse_args()
+
+    settings = {"beams": args.beams,
+                "vocab_sizes": args.vocab_sizes,
+                "lengths": args.lengths,
+                "sentences": args.sentences,
+                "blank_ratio": args.blank_ratio,
+                "blank_threshold": args.blank_threshold,
+                "seed": args.seed,
+                "weights": WEIGHTS}
+    decode_options = {"blank_threshold": args.blank_threshold,
+                      "candidate_mass": args.candidate_mass,
+                      "lm_bound": args.lm_bound,
+                      "beam_margin": args.beam_margin,
+                      "min_beam": args.min_beam}
+    # not compared by --check, see the module docstring
+    pruning = {"candidate_mass": args.candidate_mass,
+               "lm_bound": args.lm_bound,
+               "beam_margin": args.beam_margin,
+               "min_beam": args.min_beam,
+               "top_k": args.top_k}
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="ctc-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    cases = []
+    outputs = {}
+
+    for vocab_size in args.vocab_sizes:
+        words = synthetic_words(vocab_size)
+        vocabulary = StoredVocabulary(words)
+        arpa_path = os.path.join(work_dir, "toy.{}.arpa".format(vocab_size))
+        write_arpa(arpa_path, words,
+                   np.random.RandomState([args.seed, vocab_size]))
+        lm = NGramModel(arpa_path, cache_size=args.lm_cache_size)
+
+        for length in args.lengths:
+            random = np.random.RandomState([args.seed, vocab_size, length])
+            sentences = [synthetic_sentence(
+                             random, vocab_size, length, args.blank_ratio)
+                         for _ in range(args.sentences)]
+            frames = args.sentences * length
+
+            align_time, align_outputs = run_alignment(
+                sentences, vocabulary, lm, args.repeat)
+            cases.append({"function": "ctc_path", "vocab_size": vocab_size,
+                          "length": length, "beam": None,
+                          "sentences": args.sentences, "time": align_time,
+                          "frames_per_second": frames / align_time})
+            outputs["V={} T={} ctc_path".format(vocab_size, length)] = (
+                align_outputs)
+
+            for beam in args.beams:
+                timings, case_outputs = run_case(
+                    sentences, vocabulary, lm, beam, args.repeat,
+                    decode_options, args.top_k)
+
+                for function, time in timings.items():
+                    cases.append({"function": function,
+                                  "vocab_size": vocab_size,
+                                  "length": length, "beam": beam,
+                                  "sentences": args.sentences, "time": time,
+                                  "frames_per_second": frames / time})
+                for function, output in case_outputs.items():
+                    outputs["V={} T={} beam={} {}".format(
+                        vocab_size, length, beam, function)] = output
+
+                print("V={} T={} beam={}: {}".format(
+                    vocab_size, length, beam, ", ".join(
+                        "{} {:.3f} s".format(function, time)
+                        for function, time in timings.items())),
+                      file=sys.stderr)
+
+    results = {"revision": git_revision(),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "settings": settings,
+               "pruning": pruning,
+               "cases": cases}
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.record is not None:
+        with open(args.record, "w") as f:
+            json.dump({"settings": settings, "pruning": pruning,
+                       "outputs": outputs}, f, indent=1)
+
+    if args.check is not None:
+        with open(args.check) as f:
+            golden = json.load(f)
+
+        if golden["settings"] != json.loads(json.dumps(settings)):
+            print("The golden outputs were recorded with other settings: "
+                  "{}".format(golden["settings"]), file=sys.stderr)
+            sys.exit(1)
+
+        # outputs recorded before the options were added have none of them
+        recorded = golden.get("pruning", {key: parser.get_default(key)
+                                          for key in pruning})
+        if recorded != pruning:
+            print("Checking the outputs of the pruning options {} against "
+                  "outputs recorded with {}".format(pruning, recorded),
+                  file=sys.stderr)
+
+        differences = compare(golden["outputs"],
+                              json.loads(json.dumps(outputs)), args.tolerance)
+        for difference in differences:
+            print("Difference in {}".format(difference), file=sys.stderr)
+
+        if differences:
+            sys.exit(1)
+        print("Outputs match the golden outputs.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+from typing import Iterator, List, Tuple, Union
+import json
+import os
+import timeit
+
+import numpy as np
+import tensorflow as tf
+
+from neuralmonkey.config.configuration import Configuration
+from neuralmonkey.experiment import Experiment
+from neuralmonkey.decoders import CTCDecoder
+from neuralmonkey.model.model_part import ModelPart
+from neuralmonkey.model.sequence import EmbeddedSequence
+from neuralmonkey.runners import PlainRunner
+from neuralmonkey.runners.tensor_runner import RepresentationRunner
+from neuralmonkey.dataset import BatchingScheme, Dataset
+from neuralmonkey.vocabulary import (
+    END_TOKEN, PAD_TOKEN, START_TOKEN, UNK_TOKEN)
+
+from logits_store import SentenceLogits, StoredVocabulary, TopKFrames
+
+
+def _load_datasets(datasets_path: str):
+    test_datasets = Configuration()
+    test_datasets.add_argument("test_datasets")
+    test_datasets.add_argument("batch_size", cond=lambda x: x > 0)
+    test_datasets.add_argument("variables", cond=lambda x: isinstance(x, list))
+
+    test_datasets.load_file(datasets_path)
+    test_datasets.build_model()
+    return test_datasets.model
+
+
+def load_experiment(
+        config_path: str,
+        datasets_path: str,
+        top_k: int = None) -> Tuple[Experiment, Dataset, CTCDecoder]:
+    """Build the experiment and replace its runners by the logits runners.
+
+    If `top_k` is given, the log-softmax and the selection of the `top_k`
+    best tokens of every frame are added to the graph, and the session
+    returns only those instead of the whole logits, see `TopKFrames`.
+
+    Returns the experiment, the first test dataset and the CTC decoder.
+    """
+    datasets_model = _load_datasets(datasets_path)
+
+    exp = Experiment(config_path=config_path)
+    exp.build_model()
+    exp.load_variables(datasets_model.variables)
+
+    ctc_decoder = None
+    for runner in exp.model.runners:
+        if (isinstance(runner, PlainRunner)
+                and isinstance(runner.decoder, CTCDecoder)):
+            ctc_decoder = runner.decoder
+            break
+
+    if ctc_decoder is None:
+        raise ValueError(
+            "Was not able to detect CTC decoder in the configuration.")
+
+    # lengths are needed to strip the padding of batched logits
+    lengths_runner = RepresentationRunner(
+        output_series="lengths", encoder=ctc_decoder.encoder,
+        attribute="lengths")
+
+    if top_k is None:
+        logits_runner = RepresentationRunner(
+            output_series="logits", encoder=ctc_decoder, attribute="logits")
+        exp.model.runners = [logits_runner, lengths_runner]
+    else:
+        # the runners read the tensors as attributes of the decoder
+        with ctc_decoder.logits.graph.as_default():
+            log_probs = tf.nn.log_softmax(ctc_decoder.logits)
+            top_log_probs, top_indices = tf.nn.top_k(
+                log_probs[:, :, :-1], k=top_k)
+            null_log_probs = log_probs[:, :, -1]
+        ctc_decoder.top_k_log_probs = top_log_probs
+        ctc_decoder.top_k_indices = top_indices
+        ctc_decoder.null_log_probs = null_log_probs
+
+        exp.model.runners = [
+            RepresentationRunner(output_series=attribute,
+                                 encoder=ctc_decoder, attribute=attribute)
+            for attribute in ["top_k_log_probs", "top_k_indices",
+                              "null_log_probs"]] + [lengths_runner]
+
+    return exp, datasets_model.test_datasets[0], ctc_decoder
+
+
+def _input_sequence(ctc_decoder: CTCDecoder) -> EmbeddedSequence:
+    """Find the embedded input sequence the CTC decoder depends on."""
+    sequences = []
+    parts = [ctc_decoder]
+    seen = set()
+
+    while parts:
+        part = parts.pop()
+        if id(part) in seen:
+            continue
+        seen.add(id(part))
+
+        if isinstance(part, EmbeddedSequence):
+            sequences.append(part)
+
+        for value in vars(part).values():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            parts.extend(v for v in values if isinstance(v, ModelPart))
+
+    if len(sequences) != 1:
+        raise ValueError("Expected one embedded input sequence of the CTC "
+                         "decoder, found {}.".format(len(sequences)))
+    return sequences[0]
+
+
+def export_frozen(exp: Experiment, ctc_decoder: CTCDecoder, path: str,
+                  top_k: int = None) -> None:
+    """Save the inference graph of the CTC model with the variables frozen.
+
+    The graph goes from the token indices and the mask of the input
+    sequence to the logits and their lengths, and to the best tokens of
+    every frame if the experiment was loaded with `top_k`. Together with
+    both vocabularies, it is all `FrozenModel` needs.
+    """
+    sequence = _input_sequence(ctc_decoder)
+    for tensor in (sequence.inputs, sequence.mask):
+        if tensor.op.type != "Placeholder":
+            raise ValueError("The input {} is not a placeholder, the model "
+                             "cannot be exported.".format(tensor.name))
+
+    outputs = {"logits": ctc_decoder.logits,
+               "lengths": ctc_decoder.encoder.lengths}
+    if top_k is not None:
+        for attribute in ["top_k_log_probs", "top_k_indices",
+                          "null_log_probs"]:
+            outputs[attribute] = getattr(ctc_decoder, attribute)
+
+    session = exp.config.model.tf_manager.sessions[0]
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(),
+        [tensor.op.name for tensor in outputs.values()])
+
+    # only the train mode flags may be fed besides the input sequence
+    flags = []
+    for node in graph_def.node:
+        if node.op != "Placeholder" or node.name in (
+                sequence.inputs.op.name, sequence.mask.op.name):
+            continue
+        if node.attr["dtype"].type != tf.bool.as_datatype_enum:
+            raise ValueError("Unexpected input {} of the CTC model.".format(
+                node.name))
+        flags.append(node.name + ":0")
+
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "graph.pb"), "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+    source_vocabulary = sequence.vocabulary
+    for name, vocabulary in [("source_vocab.txt", source_vocabulary),
+                             ("vocab.txt", ctc_decoder.vocabulary)]:
+        with open(os.path.join(path, name), "w", encoding="utf-8") as f:
+            for word in vocabulary.index_to_word:
+                f.write(word + "\n")
+
+    special = {token: source_vocabulary.word_to_index[token]
+               for token in (PAD_TOKEN, START_TOKEN, END_TOKEN, UNK_TOKEN)}
+    meta = {"outputs": {key: tensor.name for key, tensor in outputs.items()},
+            "inputs": sequence.inputs.name,
+            "mask": sequence.mask.name,
+            "flags": flags,
+            "source_series": sequence.data_id,
+            "max_length": sequence.max_length,
+            "add_start_symbol": bool(getattr(sequence, "add_start_symbol",
+                                             False)),
+            "add_end_symbol": bool(getattr(sequence, "add_end_symbol",
+                                           False)),
+            "special_tokens": special,
+            "top_k": top_k}
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+class FrozenModel(object):
+    """CTC model exported by `export_frozen`.
+
+    Stands in for the experiment in `model_logits` and `sentence_logits`
+    without building the Neural Monkey model. The input sentences are
+    converted to indices the same way as by the embedded sequence of the
+    model, and the session returns the same outputs as the runners of
+    `load_experiment`.
+    """
+
+    def __init__(self, path: str, top_k: bool = False) -> None:
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        if top_k and self.meta["top_k"] is None:
+            raise ValueError("The model was exported without the top-k "
+                             "outputs.")
+
+        graph = tf.Graph()
+        with graph.as_default():
+            graph_def = tf.GraphDef()
+            with open(os.path.join(path, "graph.pb"), "rb") as f:
+                graph_def.ParseFromString(f.read())
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=graph)
+
+        keys = (["top_k_log_probs", "top_k_indices", "null_log_probs"]
+                if top_k else ["logits"])
+        self.fetches = {key: graph.get_tensor_by_name(self.meta["outputs"][key])
+                        for key in keys + ["lengths"]}
+        self.inputs = graph.get_tensor_by_name(self.meta["inputs"])
+        self.mask = graph.get_tensor_by_name(self.meta["mask"])
+        self.flags = [graph.get_tensor_by_name(name)
+                      for name in self.meta["flags"]]
+
+        with open(os.path.join(path, "vocab.txt"), encoding="utf-8") as f:
+            self.vocabulary = StoredVocabulary(
+                [line.rstrip("\n") for line in f])
+        with open(os.path.join(path, "source_vocab.txt"),
+                  encoding="utf-8") as f:
+            self.source_index = {line.rstrip("\n"): i
+                                 for i, line in enumerate(f)}
+
+    def feed_dict(self, sources: List[List[str]]) -> dict:
+        special = self.meta["special_tokens"]
+        unk = special[UNK_TOKEN]
+
+        sequences = []
+        for tokens in sources:
+            indices = [self.source_index.get(token, unk) for token in tokens]
+            if self.meta["add_start_symbol"]:
+                indices.insert(0, special[START_TOKEN])
+            if self.meta["add_end_symbol"]:
+                indices.append(special[END_TOKEN])
+            sequences.append(indices[:self.meta["max_length"]])
+
+        width = max(len(indices) for indices in sequences)
+        inputs = np.full((len(sequences), width), special[PAD_TOKEN],
+                         dtype=np.int32)
+        mask = np.zeros((len(sequences), width), dtype=np.float32)
+        for i, indices in enumerate(sequences):
+            inputs[i, :len(indices)] = indices
+            mask[i, :len(indices)] = 1.0
+
+        feed_dict = {self.inputs: inputs, self.mask: mask}
+        feed_dict.update((flag, False) for flag in self.flags)
+        return feed_dict
+
+    def run_model(self, dataset: Dataset, write_out: bool = False,
+                  batch_size: int = None) -> Tuple[None, dict, dict]:
+        """Run the batch, the results are structured like those of
+        `Experiment.run_model`."""
+        # pylint: disable=unused-argument
+        sources = list(dataset.get_series(self.meta["source_series"]))
+        outputs = self.session.run(self.fetches, self.feed_dict(sources))
+
+        series = {}
+        if "target" in dataset.series:
+            series["target"] = list(dataset.get_series("target"))
+
+        return None, outputs, series
+
+
+def load_frozen(path: str, datasets_path: str,
+                top_k: bool = False) -> Tuple[FrozenModel, Dataset]:
+    """Load a model saved by `export_frozen` and the first test dataset."""
+    model = FrozenModel(path, top_k)
+    return model, _load_datasets(datasets_path).test_datasets[0]
+
+
+def close_experiment(exp: Union[Experiment, FrozenModel]) -> None:
+    if isinstance(exp, FrozenModel):
+        exp.session.close()
+        return
+
+    for session in exp.config.model.tf_manager.sessions:
+        session.close()
+
+
+def _run_batch(
+        exp: Union[Experiment, FrozenModel],
+        batch: Dataset,
+        indices: List[int],
+        targets: List[List[str]]) -> List[SentenceLogits]:
+
+    t1 = timeit.default_timer()
+    ctc_model_result = exp.run_model(
+        batch, write_out=False, batch_size=len(indices))
+    t2 = timeit.default_timer()
+
+    outputs = ctc_model_result[1]
+    lengths = np.asarray(outputs["lengths"]).reshape(-1)
+
+    # logits are time-major: time x batch x vocabulary
+    if "logits" in outputs:
+        logits = np.asarray(outputs["logits"])
+        batch_logits = [logits[:lengths[i], i]
+                           for i in range(len(indices))]
+    else:
+        top_log_probs = np.asarray(outputs["top_k_log_probs"])
+        top_indices = np.asarray(outputs["top_k_indices"])
+        null_log_probs = np.asarray(outputs["null_log_probs"])
+        batch_logits = [TopKFrames(top_indices[:lengths[i], i],
+                                      top_log_probs[:lengths[i], i],
+                                      null_log_probs[:lengths[i], i])
+                           for i in range(len(indices))]
+
+    if targets is None and "target" in ctc_model_result[2]:
+        targets = ctc_model_result[2]["target"]
+
+    model_time = (t2 - t1) / len(indices)
+
+    return [SentenceLogits(
+                index,
+                batch_logits[i],
+                targets[i] if targets is not None else None,
+                model_time)
+            for i, index in enumerate(indices)]
+
+
+def sentence_logits(
+        exp: Union[Experiment, FrozenModel],
+        sources: List[List[str]],
+        series: str = "source") -> List[SentenceLogits]:
+    """Run the CTC model over tokenized sentences as a single batch."""
+    batch = Dataset(name="requests", iterators={series: lambda: iter(sources)})
+    return _run_batch(exp, batch, list(range(len(sources))), None)
+
+
+def _bucket_batches(
+        dataset: Dataset,
+        batch_size: int,
+        bucket_window: int,
+        length_series: str) -> Iterator[List[Tuple[List[int], Dataset, List]]]:
+    """Read the dataset by windows, sort each one by length and batch it.
+
+    Sorting brings sentences of similar length into one batch, so that
+    little computation is wasted on padding.
+    """
+    series = dataset.series
+    sentences = enumerate(zip(*[dataset.get_series(s) for s in series]))
+
+    while True:
+        window = [sent for _, sent in zip(range(bucket_window), sentences)]
+        if not window:
+            return
+
+        window.sort(key=lambda x: len(x[1][series.index(length_series)]))
+
+        batches = []
+        for start in range(0, len(window), batch_size):
+            chunk = window[start:start + batch_size]
+            data = list(zip(*[sent for _, sent in chunk]))
+
+            iterators = {s: (lambda d=d: iter(d)) for s, d in zip(series, data)}
+            batch = Dataset(name="{}-bucket".format(dataset.name),
+                            iterators=iterators)
+
+            targets = (list(data[series.index("target")])
+                       if "target" in series else None)
+            batches.append(([index for index, _ in chunk], batch, targets))
+
+        yield batches
+
+
+def model_logits(
+        exp: Union[Experiment, FrozenModel],
+        dataset: Dataset,
+        batch_size: int = 1,
+        bucket_window: int = 0,
+        length_series: str = "source",
+        start: int = 0) -> Iterator[SentenceLogits]:
+    """Run the CTC model over the dataset and yield logits per sentence.
+
+    Sentences are run in batches of `batch_size`. If `bucket_window` is
+    positive, this many sentences are read ahead and sorted by the length
+    of `length_series` before batching. The sentences are always yielded
+    in the original order of the dataset. Sentences before `start` are
+    skipped, batches of only such sentences are not run at all.
+    """
+    if bucket_window > 0:
+        for batches in _bucket_batches(
+                dataset, batch_size, bucket_window, length_series):
+            window = []
+            for indices, batch, targets in batches:
+                if max(indices) >= start:
+                    window.extend(_run_batch(exp, batch, indices, targets))
+
+            window.sort(key=lambda sent: sent.index)
+            yield from (sent for sent in window if sent.index >= start)
+    else:
+        batch_start = 0
+        for batch in dataset.batches(BatchingScheme(batch_size)):
+            indices = list(range(batch_start, batch_start + batch.length))
+            batch_start += batch.length
+
+            if indices[-1] >= start:
+                yield from (
+                    sent for sent in _run_batch(exp, batch, indices, None)
+                    if sent.index >= start)
@@ -0,0 +1,129 @@
+from typing import (TYPE_CHECKING, Any, Counter, Iterable, Iterator, List,
+                    NamedTuple, Tuple)
+import collections
+import multiprocessing
+import os
+import timeit
+
+import numpy as np
+
+from beam_search import decode_beam
+from logits_store import LogitsStore
+from n_gram_model import NGramModel
+if TYPE_CHECKING:
+    from neuralmonkey.vocabulary import Vocabulary
+
+
+DecodedSentence = NamedTuple("DecodedSentence", [
+    ("tokens", List[str]),
+    ("decode_time", float),
+    ("stats", Counter),
+    ("n_best", List[Tuple[List[str], np.ndarray]])])  # None if not kept
+
+# state of a worker process, loaded once by `init_worker`
+WORKER = {}
+
+
+def decode_sentence(
+        logits: np.ndarray,
+        beam_width: int,
+        vocabulary: "Vocabulary",
+        lm: NGramModel,
+        weights: dict,
+        decode_options: dict = None) -> DecodedSentence:
+    """Decode one sentence, `decode_options` are passed to `decode_beam`.
+
+    The final beam is returned as well if the option `n_best` is true.
+    """
+    decode_options = dict(decode_options or {})
+    stats = collections.Counter()
+    n_best = [] if decode_options.pop("n_best", False) else None
+
+    t1 = timeit.default_timer()
+    best_hyp = decode_beam(
+        logits, beam_width, vocabulary, lm=lm, weights=weights, stats=stats,
+        n_best=n_best, **decode_options)
+    t2 = timeit.default_timer()
+
+    return DecodedSentence(best_hyp.tokens, t2 - t1, stats, n_best)
+
+
+def init_worker(name: str, kenlm_path: str, lm_options: dict,
+                state: dict) -> None:
+    """Load the LM of a worker process and keep it in `WORKER` with the
+    rest of the `state`, the initializer of the decoding and training
+    pools."""
+    WORKER["lm"] = NGramModel(kenlm_path, **lm_options)
+    print("{} process {}: LM {}".format(
+        name, os.getpid(), WORKER["lm"].load_stats()), flush=True)
+    WORKER.update(state)
+
+
+def worker_store() -> LogitsStore:
+    """Return the logits store at `WORKER["store_path"]`.
+
+    Every worker opens the store itself on the first use, so that the
+    logits do not have to be pickled and sent with the tasks.
+    """
+    if "store" not in WORKER:
+        WORKER["store"] = LogitsStore(WORKER["store_path"])
+    return WORKER["store"]
+
+
+def _decode_task(logits: np.ndarray) -> DecodedSentence:
+    return decode_sentence(
+        logits, WORKER["beam_width"], WORKER["vocabulary"],
+        WORKER["lm"], WORKER["weights"], WORKER["decode_options"])
+
+
+class DecoderPool(object):
+    """Beam decoding in a pool of worker processes.
+
+    Every worker loads the language model once when it starts. The workers
+    are forked from a separate server process, so they do not inherit the
+    TensorFlow sessions of the main process.
+    """
+
+    def __init__(self,
+                 workers: int,
+                 kenlm_path: str,
+                 vocabulary: "Vocabulary",
+                 beam_width: int,
+                 weights: dict,
+                 max_pending: int = None,
+                 lm_options: dict = None,
+                 decode_options: dict = None) -> None:
+        context = multiprocessing.get_context("forkserver")
+        self.pool = context.Pool(
+            workers, initializer=init_worker,
+            initargs=("Decoding", kenlm_path, lm_options or {},
+                      {"vocabulary": vocabulary,
+                       "beam_width": beam_width,
+                       "weights": weights,
+                       "decode_options": decode_options or {}}))
+        self.max_pending = max_pending or 4 * workers
+
+    def imap(self, sentences: Iterable[Any]
+            ) -> Iterator[Tuple[Any, DecodedSentence]]:
+        """Decode the sentences and yield the results in the input order.
+
+        At most `max_pending` sentences are submitted to the workers at
+        a time, so the memory stays bounded for large datasets.
+        """
+        pending = collections.deque()
+
+        for sent in sentences:
+            pending.append(
+                (sent, self.pool.apply_async(_decode_task, (sent.logits,))))
+
+            if len(pending) >= self.max_pending:
+                sent, result = pending.popleft()
+                yield sent, result.get()
+
+        while pending:
+            sent, result = pending.popleft()
+            yield sent, result.get()
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
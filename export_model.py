@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Export the CTC model as a frozen inference graph for fast startup.
+
+The experiment is built from the INI files once, and the graph from the
+input sentence to the logits is saved with the variables turned into
+constants, see `ctc_model.export_frozen`. `run_model.py` and
+`train_model.py` load it with --frozen-model instead of building the whole
+experiment.
+
+The frozen model is checked to give the same logits as the experiment on
+the first sentences of the dataset, and the startup times of both are
+reported.
+"""
+
+# pylint: disable=unused-import, wrong-import-order
+import sys
+
+sys.path.append("./neuralmonkey")
+import neuralmonkey.checkpython
+# pylint: enable=unused-import, wrong-import-order
+
+import argparse
+import itertools
+import timeit
+
+import numpy as np
+
+from ctc_model import (close_experiment, export_frozen, load_experiment,
+                       load_frozen, model_logits)
+from logits_store import TopKFrames
+
+
+def max_difference(first, second) -> float:
+    if isinstance(first, TopKFrames):
+        if not np.array_equal(first.indices, second.indices):
+            return np.inf
+        return float(max(np.abs(first.log_probs - second.log_probs).max(),
+                         np.abs(first.null_log_probs
+                                - second.null_log_probs).max()))
+
+    if first.shape != second.shape:
+        return np.inf
+    return float(np.abs(first - second).max())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("config", metavar="INI-FILE",
+                        help="the configuration file of the experiment")
+    parser.add_argument("datasets", metavar="INI-FILE",
+                        help="the configuration file of the experiment")
+    parser.add_argument("out", metavar="DIR",
+                        help="Directory of the exported model.")
+    parser.add_argument("--top-k", type=int, default=None,
+                        help="Export also the K best tokens of every frame, "
+                        "for --top-k-in-graph with beams up to K / 2.")
+    parser.add_argument("--check-sentences", type=int, default=16,
+                        help="Compare the logits of this many sentences.")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="Batch size of the comparison.")
+    parser.add_argument("--tolerance", type=float, default=1e-4,
+                        help="Allowed absolute difference of the logits.")
+    args = parser.parse_args()
+
+    t1 = timeit.default_timer()
+    exp, dataset, ctc_decoder = load_experiment(
+        args.config, args.datasets, top_k=args.top_k)
+    t2 = timeit.default_timer()
+    print("Experiment built in {:.1f} s".format(t2 - t1))
+
+    export_frozen(exp, ctc_decoder, args.out, args.top_k)
+    print("Frozen model exported to {}".format(args.out))
+
+    t1 = timeit.default_timer()
+    frozen, _ = load_frozen(args.out, args.datasets,
+                            top_k=args.top_k is not None)
+    t2 = timeit.default_timer()
+    print("Frozen model loaded in {:.1f} s".format(t2 - t1))
+
+    differences = [
+        max_difference(sent.logits, frozen_sent.logits)
+        for sent, frozen_sent in itertools.islice(zip(
+            model_logits(exp, dataset, args.batch_size),
+            model_logits(frozen, dataset, args.batch_size)),
+            args.check_sentences)]
+
+    close_experiment(exp)
+    close_experiment(frozen)
+
+    difference = max(differences, default=0.0)
+    print("Largest difference of the logits in {} sentences: {:.2e}".format(
+        len(differences), difference))
+
+    if difference > args.tolerance:
+        print("The frozen model does not match the experiment.",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
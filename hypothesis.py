@@ -1,50 +1,101 @@
-from typing import Any, List, NamedTuple, Callable
-import copy
+from typing import Any, Dict, List, Tuple
 import numpy as np
 
+ROOT = 0
+
+class PrefixTree:
+    """Token prefixes shared by all hypotheses of a single search.
+
+    Each node stands for exactly one token sequence, so two hypotheses
+    with the same output share the node id, which can be directly used as
+    a recombination key. Tokens are only materialised on demand.
+    """
+    def __init__(self):
+        self.parents = [-1]
+        self.tokens = [None]
+        self.depths = [0]
+        self.children = {}  # type: Dict[Tuple[int, str], int]
+
+    def child(self, node: int, token: str) -> int:
+        key = (node, token)
+        child = self.children.get(key)
+
+        if child is None:
+            child = len(self.parents)
+            self.children[key] = child
+            self.parents.append(node)
+            self.tokens.append(token)
+            self.depths.append(self.depths[node] + 1)
+
+        return child
+
+    def token_list(self, node: int) -> List[str]:
+        tokens = []
+
+        while node != ROOT:
+            tokens.append(self.tokens[node])
+            node = self.parents[node]
+
+        tokens.reverse()
+        return tokens
+
+    def common_ancestor(self, nodes: List[int]) -> int:
+        """Return the node of the longest prefix shared by all the nodes."""
+        nodes = set(nodes)
+        depth = min(self.depths[node] for node in nodes)
+        nodes = {self.ancestor(node, depth) for node in nodes}
+
+        while len(nodes) > 1:
+            nodes = {self.parents[node] for node in nodes}
+
+        return nodes.pop()
+
+    def ancestor(self, node: int, depth: int) -> int:
+        while self.depths[node] > depth:
+            node = self.parents[node]
+        return node
+
+    def __len__(self):
+        return len(self.parents)
+
+
 class Hypothesis:
     def __init__(self,
-        tokens : List[str],
+        tree : PrefixTree,
+        node : int,        # node of the output prefix in the tree
         ctc_score : float, # log probability from the CTC model
         lm_score : float,  # log probability from the LM
         lm_state : Any):
 
-        self.tokens = tokens
+        self.tree = tree
+        self.node = node
         self.ctc_score = ctc_score
         self.lm_score = lm_score
         self.lm_state = lm_state
         self.null_total = 0
         self.null_trailing = 0
 
-    def recombine_with(self, hyp):
-        self.ctc_score = np.logaddexp(self.ctc_score, hyp.ctc_score)
-        self.null_trailing = max(hyp.null_trailing, self.null_trailing)
+    @property
+    def tokens(self) -> List[str]:
+        return self.tree.token_list(self.node)
 
-    def expand_by_null(self, null_score: float):
-        self.ctc_score += null_score
-        self.null_total += 1
-        self.null_trailing += 1
-
-    def expand_by_token(self, token: str, token_score: float, 
-            token_lm_score: float, new_lm_state: Any):
-
-        self.tokens.append(token)
-        self.ctc_score += token_score
-        self.lm_score += token_lm_score
-        self.lm_state = new_lm_state
-        self.null_trailing = 0
+    @property
+    def tokens_cnt(self) -> int:
+        return self.tree.depths[self.node]
 
     def __repr__(self):
         return "Hypothesis(tokens={}, ctc_score={}, lm_score={}, null_total={}, null_trailing={})".format(
-            self.tokens, 
-            self.ctc_score, 
+            self.tokens,
+            self.ctc_score,
             self.lm_score,
             self.null_total,
             self.null_trailing)
 
     def __deepcopy__(self, memo=None):
+        # the tree is shared, only the node id is copied
         hyp = Hypothesis(
-            self.tokens[:],
+            self.tree,
+            self.node,
             self.ctc_score,
             self.lm_score,
             self.lm_state)
@@ -54,4 +105,55 @@ class Hypothesis:
 
         return hyp
 
-ExpandFunction = Callable[[Hypothesis, str, float], Hypothesis]
+
+class Beam:
+    """Hypotheses of one search step stored as parallel arrays.
+
+    The i-th hypothesis is described by the i-th item of every array, the
+    LM states are kept in a plain list.
+    """
+    def __init__(self,
+        tree : PrefixTree,
+        nodes,
+        ctc_score,
+        lm_score,
+        tokens_cnt,
+        null_total,
+        null_trailing,
+        lm_states : List[Any]):
+
+        self.tree = tree
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.ctc_score = np.asarray(ctc_score, dtype=np.float64)
+        self.lm_score = np.asarray(lm_score, dtype=np.float64)
+        self.tokens_cnt = np.asarray(tokens_cnt, dtype=np.int64)
+        self.null_total = np.asarray(null_total, dtype=np.int64)
+        self.null_trailing = np.asarray(null_trailing, dtype=np.int64)
+        self.lm_states = lm_states
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def select(self, indices) -> "Beam":
+        return Beam(
+            self.tree,
+            self.nodes[indices],
+            self.ctc_score[indices],
+            self.lm_score[indices],
+            self.tokens_cnt[indices],
+            self.null_total[indices],
+            self.null_trailing[indices],
+            [self.lm_states[i] for i in indices])
+
+    def hypothesis(self, index: int) -> Hypothesis:
+        hyp = Hypothesis(
+            self.tree,
+            int(self.nodes[index]),
+            float(self.ctc_score[index]),
+            float(self.lm_score[index]),
+            self.lm_states[index])
+
+        hyp.null_total = int(self.null_total[index])
+        hyp.null_trailing = int(self.null_trailing[index])
+
+        return hyp
@@ -0,0 +1,151 @@
+from typing import Iterable, Iterator, List, NamedTuple
+import json
+import os
+
+import numpy as np
+
+
+SentenceLogits = NamedTuple("SentenceLogits", [
+    ("index", int),           # position of the sentence in the dataset
+    ("logits", np.ndarray),   # time x vocabulary, without padding, or
+                              # TopKFrames
+    ("target", List[str]),    # None if the dataset has no targets
+    ("model_time", float)])   # share of the batch run time
+
+
+class TopKFrames(object):
+    """The best tokens of every frame, selected in the TensorFlow graph.
+
+    Stands in for the logits of a sentence when the model returns only the
+    `k` most probable tokens of every frame with their log probabilities,
+    sorted in descending order, and the log probability of the null token.
+    """
+
+    def __init__(self, indices: np.ndarray, log_probs: np.ndarray,
+                 null_log_probs: np.ndarray) -> None:
+        self.indices = indices                # time x k
+        self.log_probs = log_probs            # time x k
+        self.null_log_probs = null_log_probs  # time
+
+    def __len__(self) -> int:
+        return len(self.null_log_probs)
+
+
+class StoredVocabulary(object):
+    """Word list of the CTC decoder, all the decoder needs to know."""
+
+    def __init__(self, words: List[str]) -> None:
+        self.index_to_word = words
+        self.word_to_index = {word: i for i, word in enumerate(words)}
+
+    def __len__(self) -> int:
+        return len(self.index_to_word)
+
+
+class LogitsStore(object):
+    """Logits of a whole dataset in a memory-mapped file.
+
+    The store is a directory with the logits of all sentences concatenated
+    along the time axis (`logits.bin`), the first frame and the number of
+    frames of every sentence (`index.npy`), the vocabulary and the targets
+    if they were known. Reading it does not need TensorFlow.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+
+        self.index = np.load(os.path.join(path, "index.npy"))
+
+        # empty files cannot be memory-mapped
+        if meta["frames"]:
+            self.data = np.memmap(
+                os.path.join(path, "logits.bin"), dtype=meta["dtype"],
+                mode="r", shape=(meta["frames"], meta["columns"]))
+        else:
+            self.data = np.zeros((0, meta["columns"]), dtype=meta["dtype"])
+
+        with open(os.path.join(path, "vocab.txt"), encoding="utf-8") as f:
+            self.vocabulary = StoredVocabulary(
+                [line.rstrip("\n") for line in f])
+
+        self.targets = None
+        if meta["has_targets"]:
+            with open(os.path.join(path, "target.txt"), encoding="utf-8") as f:
+                self.targets = [line.split() for line in f]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> SentenceLogits:
+        start, length = self.index[i]
+        logits = np.asarray(self.data[start:start + length], dtype=np.float32)
+        target = self.targets[i] if self.targets is not None else None
+
+        return SentenceLogits(i, logits, target, 0.0)
+
+    def sentences(self, start: int = 0) -> Iterator[SentenceLogits]:
+        for i in range(start, len(self)):
+            yield self[i]
+
+
+class LogitsStoreWriter(object):
+    """Write logits of consecutive sentences to a `LogitsStore`."""
+
+    def __init__(self, path: str, vocabulary,
+                 dtype: str = "float32") -> None:
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.vocabulary = vocabulary
+        self.dtype = np.dtype(dtype)
+        self.data_file = open(os.path.join(path, "logits.bin"), "wb")
+        self.index = []
+        self.targets = []
+        self.frames = 0
+        self.columns = None
+
+    def write(self, sent: SentenceLogits) -> None:
+        if sent.index != len(self.index):
+            raise ValueError("Sentences must be written in the dataset order.")
+
+        if self.columns is None:
+            self.columns = sent.logits.shape[1]
+
+        sent.logits.astype(self.dtype).tofile(self.data_file)
+        self.index.append((self.frames, len(sent.logits)))
+        self.targets.append(sent.target)
+        self.frames += len(sent.logits)
+
+    def write_through(
+            self, sentences: Iterable[SentenceLogits]
+        ) -> Iterator[SentenceLogits]:
+        """Write the sentences while passing them on."""
+        for sent in sentences:
+            self.write(sent)
+            yield sent
+
+    def close(self) -> None:
+        self.data_file.close()
+
+        has_targets = all(target is not None for target in self.targets)
+
+        np.save(os.path.join(self.path, "index.npy"),
+                np.array(self.index, dtype=np.int64).reshape(-1, 2))
+
+        with open(os.path.join(self.path, "vocab.txt"), "w",
+                  encoding="utf-8") as f:
+            for word in self.vocabulary.index_to_word:
+                f.write(word + "\n")
+
+        if has_targets:
+            with open(os.path.join(self.path, "target.txt"), "w",
+                      encoding="utf-8") as f:
+                for target in self.targets:
+                    f.write(" ".join(target) + "\n")
+
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"dtype": self.dtype.name,
+                       "frames": self.frames,
+                       "columns": self.columns or 0,
+                       "has_targets": has_targets}, f)
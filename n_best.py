@@ -0,0 +1,86 @@
+from typing import List, Tuple
+import json
+import os
+
+import numpy as np
+
+from beam_search import FEATURES
+
+
+# hypotheses of one sentence with their FEATURES, as `decode_beam` keeps them
+NBestList = List[Tuple[List[str], np.ndarray]]
+
+
+class NBestStore(object):
+    """N-best lists of a whole dataset with the features of the hypotheses.
+
+    The store is a directory with the FEATURES of all hypotheses in one
+    matrix (`features.bin`), the first row and the number of hypotheses of
+    every sentence (`index.npy`), the hypotheses one per line
+    (`hypotheses.txt`) and the decoding settings (`meta.json`). Re-ranking
+    the hypotheses with other weights needs neither the logits nor the LM.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+
+        if self.meta["features"] != FEATURES:
+            raise ValueError("The store has features {}, expected {}.".format(
+                self.meta["features"], FEATURES))
+
+        self.index = np.load(os.path.join(path, "index.npy"))
+        self.features = np.fromfile(
+            os.path.join(path, "features.bin"), dtype=np.float64).reshape(
+                -1, len(FEATURES))
+
+        with open(os.path.join(path, "hypotheses.txt"),
+                  encoding="utf-8") as f:
+            self.hypotheses = [line.split() for line in f]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> NBestList:
+        start, count = self.index[i]
+        return list(zip(self.hypotheses[start:start + count],
+                        self.features[start:start + count]))
+
+
+class NBestWriter(object):
+    """Write N-best lists of consecutive sentences to an `NBestStore`.
+
+    `settings` are saved in the metadata, e.g. the beam and the weights
+    the lists were decoded with.
+    """
+
+    def __init__(self, path: str, settings: dict = None) -> None:
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.settings = settings or {}
+        self.features_file = open(os.path.join(path, "features.bin"), "wb")
+        self.hypotheses_file = open(os.path.join(path, "hypotheses.txt"), "w",
+                                    encoding="utf-8")
+        self.index = []
+        self.rows = 0
+
+    def write(self, n_best: NBestList) -> None:
+        for tokens, features in n_best:
+            np.asarray(features, dtype=np.float64).tofile(self.features_file)
+            self.hypotheses_file.write(" ".join(tokens) + "\n")
+
+        self.index.append((self.rows, len(n_best)))
+        self.rows += len(n_best)
+
+    def close(self) -> None:
+        self.features_file.close()
+        self.hypotheses_file.close()
+
+        np.save(os.path.join(self.path, "index.npy"),
+                np.array(self.index, dtype=np.int64).reshape(-1, 2))
+
+        meta = {"features": FEATURES, "rows": self.rows}
+        meta.update(self.settings)
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
@@ -1,27 +1,230 @@
+from typing import Any, List, Sequence, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+import argparse
+import collections
+import os
+import resource
+import timeit
 import kenlm
-import copy
-from hypothesis import Hypothesis, ExpandFunction
+import numpy as np
 
 
-class NGramModel(object):
+# how KenLM loads binary models, ARPA files are always read into memory
+LOAD_METHODS = {
+    # map the file and page it in on demand, processes share the page cache
+    "lazy": kenlm.LoadMethod.LAZY,
+    # map the file and read it all at once, still shared
+    "populate": kenlm.LoadMethod.POPULATE_OR_LAZY,
+    # copy the model to the private memory of the process
+    "read": kenlm.LoadMethod.READ,
+    "parallel-read": kenlm.LoadMethod.PARALLEL_READ}
+
+
+def add_load_argument(parser: argparse.ArgumentParser) -> None:
+    """Add the --lm-load option choosing one of LOAD_METHODS."""
+    parser.add_argument("--lm-load", type=str, default=None,
+                        choices=sorted(LOAD_METHODS),
+                        help="How to load a binary LM: lazy and populate map "
+                        "the file, so processes on one node share it, read "
+                        "copies it to every process (default: KenLM's "
+                        "choice).")
 
-    def __init__(self, path: str):
-        self.model = kenlm.LanguageModel(path)
 
-    def expand_token(
-            self, prev: Hypothesis, token: str,
-            token_score: float) -> Hypothesis:
+def memory_usage() -> Tuple[int, int]:
+    """Return the resident and the shared memory of the process in bytes.
 
-        if prev.lm_state is None:
-            prev_state = kenlm.State()
-            self.model.BeginSentenceWrite(prev_state)
+    The shared memory includes mapped files, i.e. LMs loaded lazily. Other
+    systems than Linux only report the peak resident size.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            fields = statm.read().split()
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        return int(fields[1]) * page_size, int(fields[2]) * page_size
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, 0
+
+
+class NGramModel(object):
+
+    def __init__(self, path: str, cache_size: int = 0,
+                 persistent_cache: bool = False, load_method: str = None):
+        """Load the KenLM model.
+
+        Arguments:
+            path: Path to the ARPA or binary KenLM model.
+            cache_size: Maximum number of (LM state, token) transitions kept
+                in the LRU cache, zero disables the cache.
+            persistent_cache: Keep the cache across sentences.
+            load_method: One of LOAD_METHODS, KenLM chooses by default.
+        """
+        t1 = timeit.default_timer()
+        if load_method is not None:
+            config = kenlm.Config()
+            config.load_method = LOAD_METHODS[load_method]
+            self.model = kenlm.LanguageModel(path, config)
         else:
-            prev_state = prev.lm_state
+            self.model = kenlm.LanguageModel(path)
+        self.load_time = timeit.default_timer() - t1
+
+        self.begin_state = kenlm.State()
+        self.model.BeginSentenceWrite(self.begin_state)
+
+        # vocabulary indices to KenLM words, see `set_vocabulary`
+        self.vocabulary = None
+        self.index_to_lm_word = None  # type: List[str]
+        self.unigram_scores = None  # type: np.ndarray
+
+        self.cache_size = cache_size
+        self.persistent_cache = persistent_cache
+        self.cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+
+    def start_sentence(self) -> None:
+        if not self.persistent_cache:
+            self.cache.clear()
+
+    def set_vocabulary(self, vocabulary) -> None:
+        """Map the indices of the vocabulary to KenLM words.
+
+        The mapping is used by `score_tokens` and `score_sequence`, it is
+        only built again for another vocabulary.
+        """
+        if vocabulary is self.vocabulary:
+            return
+
+        self.vocabulary = vocabulary
+        self.index_to_lm_word = [str(word) for word in vocabulary.index_to_word]
+        self.unigram_scores = None
+
+        # the cache keys are vocabulary indices
+        self.cache.clear()
+
+    def token_bounds(self, kind: str) -> np.ndarray:
+        """Return the bounds of the LM scores of the vocabulary tokens.
+
+        `zero` is the upper bound of any log probability. `unigram` is the
+        score of the token without context, which is cheaper to beat, but
+        a token can have a higher score in a context it was seen in.
+        """
+        if kind == "zero":
+            return np.zeros(len(self.index_to_lm_word))
+
+        if kind != "unigram":
+            raise ValueError("Unknown LM bound: {}".format(kind))
+
+        if self.unigram_scores is None:
+            null_state = kenlm.State()
+            self.model.NullContextWrite(null_state)
+            self.unigram_scores = np.array(
+                [self.model.BaseScore(null_state, word, kenlm.State())
+                 for word in self.index_to_lm_word])
+
+        return self.unigram_scores
+
+    def load_stats(self) -> str:
+        resident, shared = memory_usage()
+        return ("loaded in {:.1f} s, process resident {:.0f} MB, "
+                "{:.0f} MB of it shared".format(
+                    self.load_time, resident / 2**20, shared / 2**20))
+
+    def cache_stats(self) -> str:
+        return "{} hits, {} misses, {} evictions".format(
+            self.cache_hits, self.cache_misses, self.cache_evictions)
+
+    def _base_score(self, prev_state: Any, token: str) -> Tuple[float, Any]:
+        if prev_state is None:
+            prev_state = self.begin_state
 
         new_lm_state = kenlm.State()
         token_lm_score = self.model.BaseScore(prev_state, token, new_lm_state)
 
-        hyp = copy.deepcopy(prev)
-        hyp.expand_by_token(token, token_score, token_lm_score, new_lm_state)
+        return token_lm_score, new_lm_state
+
+    def _transition(self, prev_state: Any, index: int) -> Tuple[float, Any]:
+        """Return the LM score of the token with the vocabulary index and the
+        successor LM state, cached by the state and the index.
+
+        `None` stands for the state at the beginning of the sentence.
+        """
+        token = self.index_to_lm_word[index]
+        if self.cache_size <= 0:
+            return self._base_score(prev_state, token)
+
+        cache_key = (prev_state, index)
+        transition = self.cache.get(cache_key)
+
+        if transition is not None:
+            self.cache.move_to_end(cache_key)
+            self.cache_hits += 1
+            return transition
+
+        self.cache_misses += 1
+        transition = self._base_score(prev_state, token)
+        self.cache[cache_key] = transition
+
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+            self.cache_evictions += 1
+
+        return transition
+
+    def score_tokens(self, prev_state: Any,
+                     indices: Sequence[int]) -> Tuple[List[float], List[Any]]:
+        """Score the tokens with the given vocabulary indices after a state.
+
+        Returns the LM scores and the successor states of all the tokens,
+        `set_vocabulary` must be called first.
+        """
+        words = self.index_to_lm_word
+        scores = []
+        states = []
+
+        if self.cache_size <= 0:
+            base_score = self.model.BaseScore
+            if prev_state is None:
+                prev_state = self.begin_state
+
+            for index in indices:
+                new_state = kenlm.State()
+                scores.append(base_score(prev_state, words[index], new_state))
+                states.append(new_state)
+        else:
+            for index in indices:
+                score, new_state = self._transition(prev_state, index)
+                scores.append(score)
+                states.append(new_state)
+
+        return scores, states
+
+    def score_sequence(
+            self, indices: Sequence[int]) -> Tuple[List[float], List[Any]]:
+        """Score a sentence prefix given by vocabulary indices.
+
+        Returns the LM scores of the tokens and the states after them.
+        """
+        state = None
+        scores = []
+        states = []
+
+        for index in indices:
+            score, state = self._transition(state, index)
+            scores.append(score)
+            states.append(state)
+
+        return scores, states
+
+
+def load_in_background(path: str, **options) -> Future:
+    """Start loading the model in a thread, return the future `NGramModel`.
 
-        return hyp
\ No newline at end of file
+    The LM is meant to load while TensorFlow builds and restores the CTC
+    model. KenLM does not release the GIL, so the loads only overlap with
+    the parts of TensorFlow which do, such as restoring the variables.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(NGramModel, path, **options)
+    executor.shutdown(wait=False)
+    return future
@@ -159,6 +159,10 @@ if [ ! -z "$LM_SCORE_DEFAULT" ] || [ ! -z "$NULL_TRAILING_DEFAULT" ] || [ ! -z "
     CNT=`ls -1 $WEIGHTS_PREFIX.*[!out] | wc -l`
     echo "Checkpoints to validate: $CNT"
 
+    # logits of the validation set are computed only for the first checkpoint
+    VAL_LOGITS="$TMP/$EXP_FILENAME.$INI_SUFFIX.logits"
+    rm -rf "$VAL_LOGITS"
+
     for FILE in $WEIGHTS_PREFIX.*[!out]; do
         source "$FILE"
         echo "---------------------------------"
@@ -172,7 +176,11 @@ if [ ! -z "$LM_SCORE_DEFAULT" ] || [ ! -z "$NULL_TRAILING_DEFAULT" ] || [ ! -z "
         sed -i -e 's/^src_test_name=.*$/src_test_name="validation.B.{src}.{vocab_size}.spm"/' $EXP_DATA_INI
         sed -i -e 's/^tgt_test_name=.*$/tgt_test_name="validation.B.{tgt}.{vocab_size}.spm"/' $EXP_DATA_INI
 
-        RUN_ARGS="$EXP_INI $EXP_DATA_INI --beam $BEAM_SIZE --kenlm $LM_MODEL --out $TMP_FILE.spm"
+        if [ -f "$VAL_LOGITS/meta.json" ]; then
+            RUN_ARGS="--logits-store $VAL_LOGITS --beam $BEAM_SIZE --kenlm $LM_MODEL --out $TMP_FILE.spm"
+        else
+            RUN_ARGS="$EXP_INI $EXP_DATA_INI --dump-logits $VAL_LOGITS --beam $BEAM_SIZE --kenlm $LM_MODEL --out $TMP_FILE.spm"
+        fi
 
         if [ ! -z "$LM_SCORE_DEFAULT" ]; then
             RUN_ARGS+=" --lm-weight $LM_SCORE"
@@ -211,6 +219,7 @@ if [ ! -z "$LM_SCORE_DEFAULT" ] || [ ! -z "$NULL_TRAILING_DEFAULT" ] || [ ! -z "
     source "$CHECKPOINT_BEST"
 
     rm $WEIGHTS_PREFIX.*
+    rm -rf "$VAL_LOGITS"
 fi
 
 SUFFIX="$CHECKPOINT_TYPE-$DATASET_TYPE-b$BEAM_SIZE-wl$LM_SCORE-wt$NULL_TRAILING-wr$NULL_TOKEN_RATIO"
@@ -0,0 +1,84 @@
+from typing import Any, Iterable, Iterator
+import queue
+import threading
+import timeit
+
+
+# marks the end of the items in the queue
+_END = object()
+
+
+class Prefetcher(object):
+    """Run an iterator ahead in a background thread.
+
+    The items are put into a queue of at most `depth` items, so the producer
+    works on the next ones while the consumer processes the current one.
+    This pays off when the producer runs native code which releases the
+    GIL, like a TensorFlow session. The items come out in the order of the
+    iterator, and an exception of the producer is raised in the consumer.
+
+    The time spent producing the items and the time the consumer waited for
+    them are measured; their difference is the production time hidden
+    behind the consumer.
+    """
+
+    def __init__(self, items: Iterable[Any], depth: int) -> None:
+        if depth < 1:
+            raise ValueError("The prefetch depth must be positive.")
+
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.produce_time = 0.0
+        self.wait_time = 0.0
+        self.thread = threading.Thread(
+            target=self._produce, args=(iter(items),), daemon=True)
+        self.thread.start()
+
+    def _put(self, item: Any) -> bool:
+        # the timeout lets the producer stop if nobody consumes the items
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterator: Iterator[Any]) -> None:
+        # pylint: disable=broad-except
+        try:
+            while True:
+                t1 = timeit.default_timer()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.produce_time += timeit.default_timer() - t1
+
+                if not self._put((item, None)):
+                    return
+        except Exception as exc:
+            self._put((_END, exc))
+            return
+
+        self._put((_END, None))
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            t1 = timeit.default_timer()
+            item, error = self.queue.get()
+            self.wait_time += timeit.default_timer() - t1
+
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+
+    @property
+    def saved_time(self) -> float:
+        return max(self.produce_time - self.wait_time, 0.0)
+
+    def close(self) -> None:
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,51 @@
+from typing import IO, Optional
+import json
+import os
+
+
+def sync(file: IO) -> int:
+    """Flush the file all the way to the disk and return its size."""
+    file.flush()
+    os.fsync(file.fileno())
+    return os.fstat(file.fileno()).st_size
+
+
+def save_progress(path: str, progress: dict) -> None:
+    """Replace the progress file atomically.
+
+    The new content is written to a temporary file first, so that the
+    progress file is always complete even if the process is killed.
+    """
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+        sync(f)
+
+    os.replace(tmp_path, path)
+
+
+def remove_progress(path: str) -> None:
+    """Remove the progress file of a finished run."""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def load_progress(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def open_resumed(path: str, size: int) -> IO:
+    """Open the file for appending after its first `size` bytes.
+
+    Anything written after the last recorded progress is dropped.
+    """
+    if size == 0 or not os.path.exists(path):
+        return open(path, "w")
+
+    os.truncate(path, size)
+    return open(path, "a")
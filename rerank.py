@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""Re-rank stored N-best lists with new weights and tune the weights.
+
+The N-best lists are written by `run_model.py --n-best`. The features of
+every hypothesis are stored, so choosing the best hypotheses for another
+weight vector is a single matrix product and no decoding is needed.
+Several stores of the same dataset, e.g. decoded with the weights of the
+previous tuning rounds, are merged into one pool of hypotheses.
+
+With --range, the weights of the features are tuned by the line search of
+minimum error rate training: the score of every hypothesis is a linear
+function of one weight, so the BLEU of the pool changes only where the
+upper envelope of these lines changes in some sentence, and all of these
+points are evaluated exactly. The features are optimized one at a time
+until the BLEU stops improving, optionally from several random starting
+points. The pool should be refreshed by decoding with the tuned weights
+and tuning again, until the output no longer changes.
+"""
+
+# pylint: disable=unused-import, wrong-import-order
+import sys
+
+sys.path.append("./neuralmonkey")
+import neuralmonkey.checkpython
+# pylint: enable=unused-import, wrong-import-order
+
+from typing import Dict, List, Tuple
+import argparse
+import timeit
+
+import numpy as np
+import sacrebleu
+
+from beam_search import FEATURES, weight_vector
+from n_best import NBestStore
+from sweep import parse_ranges, random_weights, spm_detokenize
+
+
+class NBestPool(object):
+    """Hypotheses of all sentences from one or more N-best stores.
+
+    The hypotheses of sentence `i` are the rows `starts[i]`, ...,
+    `starts[i + 1] - 1` of `features`. Hypotheses with the same tokens are
+    kept only once, from the first store.
+    """
+
+    def __init__(self, stores: List[NBestStore]) -> None:
+        if len({len(store) for store in stores}) != 1:
+            raise ValueError("The N-best stores have different lengths.")
+
+        self.hypotheses = []
+        features = []
+        counts = []
+
+        for i in range(len(stores[0])):
+            seen = set()
+            for store in stores:
+                for tokens, hyp_features in store[i]:
+                    if tuple(tokens) not in seen:
+                        seen.add(tuple(tokens))
+                        self.hypotheses.append(tokens)
+                        features.append(hyp_features)
+            counts.append(len(seen))
+
+        self.features = np.array(features).reshape(-1, len(FEATURES))
+        self.counts = np.array(counts)
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+        self.sentence = np.repeat(np.arange(len(counts)), counts)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def best(self, weight_vec: np.ndarray) -> np.ndarray:
+        """Return the rows of the best hypotheses of all sentences."""
+        scores = self.features.dot(weight_vec)
+        # stable, so ties are broken by the order of the N-best lists
+        order = np.lexsort((-scores, self.sentence))
+        return order[self.starts[:-1]]
+
+
+def bleu_stats(pool: NBestPool, references: List[str]) -> np.ndarray:
+    """Return the BLEU statistics of every hypothesis of the pool.
+
+    A row holds the hypothesis and reference lengths and the matched and
+    total n-gram counts, so that the corpus BLEU of any selection of the
+    hypotheses is computed from the sum of their rows.
+    """
+    stats = np.zeros((len(pool.hypotheses), 10), dtype=np.int64)
+
+    for row, (tokens, i) in enumerate(zip(pool.hypotheses, pool.sentence)):
+        score = sacrebleu.sentence_bleu(
+            spm_detokenize(tokens), [references[i]])
+        stats[row] = ([score.sys_len, score.ref_len]
+                      + list(score.counts) + list(score.totals))
+
+    return stats
+
+
+def corpus_bleu(stats: np.ndarray) -> float:
+    """Compute the corpus BLEU from summed `bleu_stats` rows."""
+    return sacrebleu.BLEU.compute_bleu(
+        stats[2:6].tolist(), stats[6:10].tolist(), int(stats[0]),
+        int(stats[1]), smooth_method="exp").score
+
+
+def upper_envelope(intercepts: np.ndarray,
+                   slopes: np.ndarray) -> Tuple[List[int], List[float]]:
+    """Find the lines `intercepts + x * slopes` which are the highest on
+    some interval of x.
+
+    Returns the lines ordered by x and the x from which each of them is the
+    highest, the first one from minus infinity.
+    """
+    lines = []
+    starts = []
+
+    for i in np.lexsort((intercepts, slopes)):
+        if lines and slopes[lines[-1]] == slopes[i]:
+            # sorted by the intercepts, keep the first one of equal lines
+            if intercepts[lines[-1]] >= intercepts[i]:
+                continue
+            lines.pop()
+            starts.pop()
+
+        start = -np.inf
+        while lines:
+            last = lines[-1]
+            start = (intercepts[last] - intercepts[i]) / (
+                slopes[i] - slopes[last])
+            if start > starts[-1]:
+                break
+            lines.pop()
+            starts.pop()
+            start = -np.inf
+
+        lines.append(i)
+        starts.append(start)
+
+    return lines, starts
+
+
+def line_search(pool: NBestPool, stats: np.ndarray, weight_vec: np.ndarray,
+                feature: str, low: float, high: float) -> Tuple[float, float]:
+    """Find the weight of the feature in [low, high] with the best BLEU,
+    the other weights fixed. Returns the weight and the BLEU."""
+    column = FEATURES.index(feature)
+    slopes = pool.features[:, column]
+    intercepts = pool.features.dot(weight_vec) - weight_vec[column] * slopes
+
+    total = np.zeros(stats.shape[1], dtype=np.int64)
+    points = []
+    changes = []
+
+    for start, end in zip(pool.starts[:-1], pool.starts[1:]):
+        lines, line_starts = upper_envelope(
+            intercepts[start:end], slopes[start:end])
+        rows = start + np.array(lines)
+        total += stats[rows[0]]
+        points.extend(line_starts[1:])
+        changes.extend(stats[rows[1:]] - stats[rows[:-1]])
+
+    order = np.argsort(points, kind="mergesort")
+    points = np.array(points)[order]
+    totals = total + np.cumsum(
+        np.array(changes, dtype=np.int64).reshape(-1, stats.shape[1])[order],
+        axis=0)
+
+    # the intervals between the points where the best hypotheses change
+    bounds = np.concatenate([[-np.inf], points, [np.inf]])
+    interval_totals = np.concatenate([[total], totals])
+
+    best_weight, best_bleu = None, -1.0
+    for i in range(len(interval_totals)):
+        if bounds[i] == bounds[i + 1]:
+            # several changes at one point, evaluate after the last one
+            continue
+        interval_low = max(bounds[i], low)
+        interval_high = min(bounds[i + 1], high)
+        if interval_low > interval_high or (
+                interval_low == interval_high and low < high):
+            continue
+
+        bleu = corpus_bleu(interval_totals[i])
+        if bleu > best_bleu:
+            best_weight = (interval_low + interval_high) / 2
+            best_bleu = bleu
+
+    return best_weight, best_bleu
+
+
+def tune_weights(pool: NBestPool, stats: np.ndarray, weights: dict,
+                 ranges: Dict[str, List[float]],
+                 max_rounds: int = 20) -> Tuple[dict, float]:
+    """Optimize the weights in the ranges one feature at a time."""
+    weights = dict(weights)
+    bleu = corpus_bleu(stats[pool.best(weight_vector(weights))].sum(axis=0))
+
+    for _ in range(max_rounds):
+        improved = False
+
+        for key, bounds in ranges.items():
+            value, new_bleu = line_search(
+                pool, stats, weight_vector(weights), key, bounds[0],
+                bounds[1])
+            if new_bleu > bleu + 1e-9:
+                weights[key] = float(value)
+                bleu = new_bleu
+                improved = True
+
+        if not improved:
+            break
+
+    return weights, bleu
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-best", type=str, action="append", required=True,
+                        help="N-best store written by run_model.py, can be "
+                        "repeated to merge the N-best lists.")
+    parser.add_argument("--ref", type=str, default=None,
+                        help="Detokenized references, needed for tuning.")
+    parser.add_argument("--lm-weight", type=float,
+                        help="Weight of the language model.")
+    parser.add_argument("--null-trail-weight", type=float,
+                        help="Weight of the null-trailing feature.")
+    parser.add_argument("--nt-ratio-weight", type=float,
+                        help="Weight of the null-token ratio feature.")
+    parser.add_argument("--range", type=str, action="append", default=[],
+                        metavar="FEATURE=LOW:HIGH", dest="ranges",
+                        help="Tune the weight of the feature in the range, "
+                        "can be repeated.")
+    parser.add_argument("--restarts", type=int, default=0,
+                        help="Tune also from this many random weights from "
+                        "the ranges.")
+    parser.add_argument("--seed", type=int, default=1234,
+                        help="Seed of the random restarts.")
+    parser.add_argument("--out", type=str, default=None,
+                        help="Path to the re-ranked output.")
+    parser.add_argument("--best", type=str, default=None,
+                        help="Path to store the weights as KEY=value.")
+    args = parser.parse_args()
+
+    stores = [NBestStore(path) for path in args.n_best]
+
+    # the weights the first store was decoded with are the default
+    weights = dict(stores[0].meta.get("weights", {}))
+
+    if args.lm_weight is not None:
+        weights['lm_score'] = args.lm_weight
+
+    if args.null_trail_weight is not None:
+        weights['null_trailing'] = args.null_trail_weight
+
+    if args.nt_ratio_weight is not None:
+        weights['null_token_ratio'] = args.nt_ratio_weight
+
+    ranges = parse_ranges(args.ranges)
+    if ranges and args.ref is None:
+        parser.error("Tuning the weights needs --ref.")
+
+    t1 = timeit.default_timer()
+    pool = NBestPool(stores)
+    t2 = timeit.default_timer()
+    print("Loaded {} hypotheses of {} sentences in {:.3f} s".format(
+        len(pool.hypotheses), len(pool), t2 - t1))
+
+    stats = None
+    if args.ref is not None:
+        with open(args.ref, encoding="utf-8") as ref_file:
+            references = [line.rstrip("\n") for line in ref_file]
+
+        if len(references) != len(pool):
+            raise ValueError("{} references for {} sentences.".format(
+                len(references), len(pool)))
+
+        stats = bleu_stats(pool, references)
+        print("BLEU {:.2f} with weights {}".format(corpus_bleu(
+            stats[pool.best(weight_vector(weights))].sum(axis=0)), weights))
+
+    if ranges:
+        for key, bounds in ranges.items():
+            if len(bounds) != 2:
+                parser.error("The range of {} must be LOW:HIGH.".format(key))
+            weights.setdefault(key, 0.0)
+            weights[key] = min(max(weights[key], bounds[0]), bounds[1])
+
+        starts = [weights] + random_weights(ranges, args.restarts, args.seed)
+        t1 = timeit.default_timer()
+        results = []
+        for start in starts:
+            start = dict(weights, **start)
+            results.append(tune_weights(pool, stats, start, ranges))
+        t2 = timeit.default_timer()
+
+        weights, bleu = max(results, key=lambda result: result[1])
+        print("Tuned BLEU {:.2f} with weights {} in {:.3f} s".format(
+            bleu, weights, t2 - t1))
+
+    t1 = timeit.default_timer()
+    best_rows = pool.best(weight_vector(weights))
+    t2 = timeit.default_timer()
+    print("Re-ranked in {:.4f} s".format(t2 - t1))
+
+    if args.out is not None:
+        with open(args.out, "w") as out_file:
+            for row in best_rows:
+                out_file.write(" ".join(pool.hypotheses[row]) + "\n")
+
+    if args.best is not None:
+        with open(args.best, "w") as best_file:
+            for key, value in weights.items():
+                best_file.write("{}={:.3f}\n".format(key.upper(), value))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,30 +7,74 @@ sys.path.append("./neuralmonkey")
 import neuralmonkey.checkpython
 # pylint: enable=unused-import, wrong-import-order
 
+from typing import Counter, List, Tuple
 import argparse
+import collections
 import json
-import os
 import timeit
 
 import numpy as np
 
-from neuralmonkey.config.configuration import Configuration
-from neuralmonkey.experiment import Experiment
-from neuralmonkey.logging import log
-from neuralmonkey.decoders import CTCDecoder
-from neuralmonkey.runners import PlainRunner
-from neuralmonkey.runners.tensor_runner import RepresentationRunner
-from neuralmonkey.dataset import BatchingScheme
+from decode_pool import DecoderPool, decode_sentence
+from logits_store import LogitsStore, LogitsStoreWriter
+from n_best import NBestWriter
+from n_gram_model import add_load_argument, load_in_background
+from prefetch import Prefetcher
+from progress import (load_progress, open_resumed, remove_progress,
+                      save_progress, sync)
+
+def beam_sizes(decode_stats: Counter) -> List[Tuple[int, int]]:
+    """Return the numbers of frames decoded with every beam size."""
+    return sorted((int(key[len("beam_size_"):]), count)
+                  for key, count in decode_stats.items()
+                  if key.startswith("beam_size_"))
+
+
+def profile_summary(stats: List[List[float]],
+                    decode_stats: Counter) -> dict:
+    """Summarize the throughput and the latencies of a profiled run."""
+    tokens = sum(line[0] for line in stats)
+    model_times = np.array([line[1] for line in stats])
+    decode_times = np.array([line[2] for line in stats])
+    decode_time = max(float(decode_times.sum()), 1e-9)
+
+    def percentiles(times):
+        return collections.OrderedDict(
+            ("p{}".format(p), float(np.percentile(times, p)) if len(times)
+             else 0.0) for p in (50, 90, 99))
+
+    summary = collections.OrderedDict([
+        ("sentences", len(stats)),
+        ("tokens", tokens),
+        ("frames", decode_stats["frames"]),
+        ("model_time", float(model_times.sum())),
+        ("decode_time", float(decode_times.sum())),
+        ("tokens_per_second", tokens / decode_time),
+        ("frames_per_second", decode_stats["frames"] / decode_time),
+        ("decode_latency", percentiles(decode_times)),
+        ("total_latency", percentiles(model_times + decode_times)),
+        ("mean_expanded_beam", decode_stats["expanded_hyps"]
+         / max(decode_stats["decoded_frames"], 1))])
+    summary.update(sorted(
+        (key, value) for key, value in decode_stats.items()
+        if not key.startswith("beam_size_")))
+    summary["beam_sizes"] = collections.OrderedDict(
+        (str(size), count) for size, count in beam_sizes(decode_stats))
+
+    return summary
+
+
+def read_profile(path: str) -> List[dict]:
+    with open(path) as profile_file:
+        return [json.loads(line) for line in profile_file]
 
-from beam_search import decode_beam
-from n_gram_model import NGramModel
 
 def main() -> None:
     # pylint: disable=no-member,broad-except
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("config", metavar="INI-FILE",
+    parser.add_argument("config", metavar="INI-FILE", nargs="?",
                         help="the configuration file of the experiment")
-    parser.add_argument("datasets", metavar="INI-FILE",
+    parser.add_argument("datasets", metavar="INI-FILE", nargs="?",
                         help="the configuration file of the experiment")
     parser.add_argument("--beam", metavar="BEAM_SIZE", type=int, default=10,
                         help="Beam size.")
@@ -44,41 +88,102 @@ def main() -> None:
                         help="Weight of the null-token ratio feature.")
     parser.add_argument("--out", type=str,
                         help="Path to the output file.")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of sentences run through the CTC model "
+                        "at once.")
+    parser.add_argument("--bucket-window", type=int, default=0,
+                        help="Number of sentences sorted by length before "
+                        "batching. Zero keeps the dataset order.")
+    parser.add_argument("--lm-cache-size", type=int, default=0,
+                        help="Number of LM transitions kept in the cache, "
+                        "zero disables the cache.")
+    parser.add_argument("--lm-cache-persistent", action="store_true",
+                        help="Keep the LM cache across sentences.")
+    add_load_argument(parser)
+    parser.add_argument("--blank-threshold", type=float, default=None,
+                        help="Expand frames where the null token probability "
+                        "is higher than this only by the null token.")
+    parser.add_argument("--candidate-mass", type=float, default=None,
+                        help="Expand every frame only by the most probable "
+                        "tokens which cover this probability mass together "
+                        "with the null token, at most 2 * beam of them.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of beam decoding processes.")
+    parser.add_argument("--max-pending", type=int, default=None,
+                        help="Maximum number of sentences waiting for the "
+                        "decoding processes (default: 4 per worker).")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        metavar="DEPTH",
+                        help="Run the model in a background thread up to "
+                        "DEPTH sentences ahead of the decoding, zero runs "
+                        "them one after another.")
+    parser.add_argument("--logits-store", type=str, default=None,
+                        help="Decode logits from this store instead of "
+                        "running the model.")
+    parser.add_argument("--dump-logits", type=str, default=None,
+                        help="Save the logits to a store at this path.")
+    parser.add_argument("--logits-dtype", type=str, default="float32",
+                        choices=["float16", "float32"],
+                        help="Data type of the dumped logits.")
+    parser.add_argument("--lm-bound", type=str, default=None,
+                        choices=["zero", "unigram"],
+                        help="Skip the LM queries of expansions which cannot "
+                        "get into the beam with the LM score bounded by zero "
+                        "(exact) or by the unigram score (approximate).")
+    parser.add_argument("--beam-margin", type=float, default=None,
+                        help="Prune also the hypotheses scoring more than "
+                        "this below the best one, BEAM_SIZE is then the "
+                        "largest beam.")
+    parser.add_argument("--min-beam", type=int, default=1,
+                        help="Smallest beam kept with --beam-margin.")
+    parser.add_argument("--top-k-in-graph", action="store_true",
+                        help="Compute the log-softmax and select the 2 * beam "
+                        "best tokens of every frame in the TensorFlow graph, "
+                        "so the session does not return the whole logits.")
+    parser.add_argument("--n-best", type=str, default=None,
+                        help="Save the final beams with the features of the "
+                        "hypotheses to an N-best store at this path, for "
+                        "re-ranking with rerank.py.")
+    parser.add_argument("--frozen-model", type=str, default=None,
+                        help="Load the CTC model exported by export_model.py "
+                        "instead of building the experiment, the only INI "
+                        "file is then the datasets one.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from the progress "
+                        "recorded in OUT.progress.")
+    parser.add_argument("--progress-every", type=int, default=10,
+                        help="Record the progress after this many sentences.")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Profile the decoder and write the counters and "
+                        "timers of every sentence to this path as JSON "
+                        "lines, the summary goes to PROFILE.summary.")
     args = parser.parse_args()
 
-    test_datasets = Configuration()
-    test_datasets.add_argument("test_datasets")
-    test_datasets.add_argument("batch_size", cond=lambda x: x > 0)
-    test_datasets.add_argument("variables", cond=lambda x: isinstance(x, list))
+    if args.frozen_model is not None and args.datasets is None:
+        # the only INI file is the datasets one
+        args.datasets, args.config = args.config, None
 
-    test_datasets.load_file(args.datasets)
-    test_datasets.build_model()
-    datasets_model = test_datasets.model
+    if args.logits_store is None and args.datasets is None:
+        parser.error("Either the INI files or --logits-store are required.")
 
-    exp = Experiment(config_path=args.config)
-    exp.build_model()
-    exp.load_variables(datasets_model.variables)
+    if args.top_k_in_graph and (args.logits_store or args.dump_logits):
+        parser.error("--top-k-in-graph cannot be used with the logits store.")
 
-    ctc_decoder = None
-    for runner in exp.model.runners:
-        if (isinstance(runner, PlainRunner)
-                and isinstance(runner.decoder, CTCDecoder)):
-            ctc_decoder = runner.decoder
-            break
+    if args.resume and (args.dump_logits or args.n_best):
+        parser.error("--resume cannot be used with --dump-logits or "
+                     "--n-best.")
 
-    if ctc_decoder is None:
-        raise ValueError(
-            "Was not able to detect CTC decoder in the configuration.")
+    if (args.blank_threshold is not None
+            and not 0.0 < args.blank_threshold <= 1.0):
+        parser.error("The blank threshold must be in (0, 1].")
 
-    logits_runner = RepresentationRunner(
-        output_series="logits", encoder=ctc_decoder, attribute="logits")
-    exp.model.runners = [logits_runner]
+    progress_path = args.out + ".progress"
+    progress = {"done": 0, "out_bytes": 0, "stats_bytes": 0,
+                "profile_bytes": 0}
 
-    dataset = datasets_model.test_datasets[0]
-    singleton_batches = dataset.batches(BatchingScheme(1))
-    print("Loading language model")
-    lm = NGramModel(args.kenlm)
-    print("LM loaded")
+    if args.resume:
+        progress = load_progress(progress_path) or progress
+        print("Resuming after {} sentences".format(progress["done"]))
 
     weights = {}
 
@@ -93,40 +198,197 @@ def main() -> None:
 
     print("Weights:", weights)
 
-    i = 0
+    lm_options = {"cache_size": args.lm_cache_size,
+                  "persistent_cache": args.lm_cache_persistent,
+                  "load_method": args.lm_load}
+
+    lm_loader = None
+    if args.workers == 1:
+        print("Loading language model")
+        lm_loader = load_in_background(args.kenlm, **lm_options)
+
+    exp = None
+    writer = None
+
+    if args.logits_store is not None:
+        store = LogitsStore(args.logits_store)
+        vocabulary = store.vocabulary
+        sentences = store.sentences(progress["done"])
+    else:
+        # imports TensorFlow, which is not needed for the stored logits
+        from ctc_model import load_experiment, load_frozen, model_logits
+
+        t1 = timeit.default_timer()
+        if args.frozen_model is not None:
+            exp, dataset = load_frozen(args.frozen_model, args.datasets,
+                                       top_k=args.top_k_in_graph)
+            if args.top_k_in_graph and exp.meta["top_k"] < 2 * args.beam:
+                parser.error("The frozen model has the best {} tokens, "
+                             "fewer than 2 * beam.".format(exp.meta["top_k"]))
+            vocabulary = exp.vocabulary
+        else:
+            exp, dataset, ctc_decoder = load_experiment(
+                args.config, args.datasets,
+                top_k=2 * args.beam if args.top_k_in_graph else None)
+            vocabulary = ctc_decoder.vocabulary
+        print("CTC model loaded in {:.1f} s".format(
+            timeit.default_timer() - t1))
+        sentences = model_logits(
+            exp, dataset, args.batch_size, args.bucket_window,
+            start=progress["done"])
+
+        if args.dump_logits is not None:
+            writer = LogitsStoreWriter(
+                args.dump_logits, vocabulary, args.logits_dtype)
+            sentences = writer.write_through(sentences)
+
+    decode_options = {"blank_threshold": args.blank_threshold,
+                      "candidate_mass": args.candidate_mass,
+                      "lm_bound": args.lm_bound,
+                      "beam_margin": args.beam_margin,
+                      "min_beam": args.min_beam}
+    if args.profile is not None:
+        decode_options["profile"] = True
+
+    n_best_writer = None
+    if args.n_best is not None:
+        decode_options["n_best"] = True
+        n_best_writer = NBestWriter(args.n_best, {"beam": args.beam,
+                                                  "weights": weights})
+
+    prefetcher = None
+    if args.prefetch > 0:
+        prefetcher = Prefetcher(sentences, args.prefetch)
+        sentences = prefetcher
+
+    if args.workers > 1:
+        print("Starting {} decoding processes".format(args.workers))
+        lm = None
+        pool = DecoderPool(args.workers, args.kenlm, vocabulary,
+                           args.beam, weights, args.max_pending, lm_options,
+                           decode_options)
+        decoded = pool.imap(sentences)
+    else:
+        pool = None
+        lm = lm_loader.result()
+        print("LM", lm.load_stats())
+        decoded = ((sent, decode_sentence(sent.logits, args.beam,
+                                          vocabulary, lm, weights,
+                                          decode_options))
+                   for sent in sentences)
+
+    i = progress["done"]
     stats = []
+    decode_stats = collections.Counter()
+    profile_file = None
+    if args.profile:
+        profile_file = open_resumed(
+            args.profile, progress.get("profile_bytes", 0))
+        # the summary covers also the sentences decoded before the resume
+        for record in read_profile(args.profile):
+            stats.append([record.pop("tokens"), record.pop("model_time"),
+                          record.pop("decode_time")])
+            del record["index"]
+            decode_stats.update(record)
+
+    out_file = open_resumed(args.out, progress["out_bytes"])
+    stats_file = open_resumed(args.out + ".stats", progress["stats_bytes"])
+
+    def record_progress() -> None:
+        progress["done"] = i
+        progress["out_bytes"] = sync(out_file)
+        progress["stats_bytes"] = sync(stats_file)
+        if profile_file is not None:
+            progress["profile_bytes"] = sync(profile_file)
+        save_progress(progress_path, progress)
+
+    t1 = timeit.default_timer()
+    for sent, result in decoded:
+        stats.append([len(result.tokens), sent.model_time,
+                      result.decode_time])
+        decode_stats.update(result.stats)
+
+        if profile_file is not None:
+            record = {"index": sent.index,
+                      "tokens": len(result.tokens),
+                      "frames": len(sent.logits),
+                      "model_time": sent.model_time,
+                      "decode_time": result.decode_time}
+            record.update(result.stats)
+            profile_file.write(json.dumps(record) + "\n")
+
+        if n_best_writer is not None:
+            n_best_writer.write(result.n_best)
+
+        output = " ".join(result.tokens)
+        out_file.write(output + "\n")
+        stats_file.write("{} {:.3f} {:.3f}\n".format(*stats[-1]))
+
+        if i % 10 == 0:
+            print("[{}] {}".format(i, output))
+        i+=1
+
+        if i % args.progress_every == 0:
+            record_progress()
+
+    out_file.close()
+    stats_file.close()
+    remove_progress(progress_path)
+    t2 = timeit.default_timer()
+
+    if prefetcher is not None:
+        prefetcher.close()
+        sequential_time = t2 - t1 + prefetcher.saved_time
+        print("Prefetching: the model ran {:.1f} s, the decoding waited "
+              "{:.1f} s for it, saving {:.1f} s of {:.1f} s ({:.1f} %)".format(
+                  prefetcher.produce_time, prefetcher.wait_time,
+                  prefetcher.saved_time, sequential_time,
+                  100 * prefetcher.saved_time / max(sequential_time, 1e-9)))
 
-    with open(args.out, 'w') as out_file:
-        for sent_dataset in singleton_batches:
+    if profile_file is not None:
+        profile_file.close()
+        summary = profile_summary(stats, decode_stats)
+        with open(args.profile + ".summary", "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        print("Decoded {tokens} tokens at {tokens_per_second:.1f} tokens/s, "
+              "{frames_per_second:.1f} frames/s".format(**summary))
+        print("Decode latency: median {:.4f} s, 90th percentile {:.4f} s, "
+              "99th percentile {:.4f} s".format(
+                  *summary["decode_latency"].values()))
 
-            t1 = timeit.default_timer()
-            ctc_model_result = exp.run_model(
-                sent_dataset, write_out=False, batch_size=1)
-            t2 = timeit.default_timer()
+    if writer is not None:
+        writer.close()
 
-            logits = np.squeeze(ctc_model_result[1]['logits'],
-                axis=1)
+    if n_best_writer is not None:
+        n_best_writer.close()
 
-            t3 = timeit.default_timer()
-            best_hyp = decode_beam(
-                logits, args.beam, ctc_decoder.vocabulary, lm=lm, weights=weights)
-            t4 = timeit.default_timer()
+    if pool is not None:
+        pool.close()
 
-            stats.append([len(best_hyp.tokens), t2-t1, t4-t3])
+    if args.blank_threshold is not None:
+        print("Skipped {} of {} frames ({:.1f} %)".format(
+            decode_stats["skipped_frames"], decode_stats["frames"],
+            100 * decode_stats["skipped_frames"] / max(decode_stats["frames"], 1)))
 
-            output = " ".join([best_hyp.tokens][0])
-            out_file.write(output + "\n")
+    if args.lm_bound is not None:
+        print("Pruned {} token expansions by the LM bound".format(
+            decode_stats["bound_pruned"]))
 
-            if i % 10 == 0:
-                print("[{}] {}".format(i, output))
-            i+=1
+    if args.beam_margin is not None:
+        sizes = beam_sizes(decode_stats)
+        frames = max(sum(count for _, count in sizes), 1)
+        print("Mean beam size {:.2f} in {} decoded frames".format(
+            sum(size * count for size, count in sizes) / frames, frames))
+        print("Beam sizes: " + ", ".join(
+            "{}: {:.1f} %".format(size, 100 * count / frames)
+            for size, count in sizes))
 
-    with open(args.out + ".stats", 'w') as stats_file:
-        for line in stats:
-            stats_file.write("{} {:.3f} {:.3f}\n".format(*line))
+    if lm is not None and lm.cache_size > 0:
+        print("LM cache:", lm.cache_stats())
 
-    for session in exp.config.model.tf_manager.sessions:
-        session.close()
+    if exp is not None:
+        from ctc_model import close_experiment
+        close_experiment(exp)
 
 
 if __name__ == "__main__":
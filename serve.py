@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""Decoding server which keeps the CTC model and the LM loaded.
+
+Requests are JSON objects, one per line on the standard input, or one per
+POST request body with --port. For example:
+
+    {"id": 1, "source": "▁Hello ▁world", "beam": 5, "weights": {"lm_score": 0.5}}
+
+The source is a tokenized sentence, either a string or a list of tokens.
+The beam size, the weights and the blank threshold are optional and default
+to the command line values. Requests arriving together are run through the
+CTC model in one batch. Every response carries the id, the output and the
+latency of the request in seconds, or the id and an error if the request is
+invalid or fails.
+"""
+
+# pylint: disable=unused-import, wrong-import-order
+import sys
+
+sys.path.append("./neuralmonkey")
+import neuralmonkey.checkpython
+# pylint: enable=unused-import, wrong-import-order
+
+from typing import Callable, List, NamedTuple
+import argparse
+import http.server
+import json
+import queue
+import signal
+import socketserver
+import threading
+import timeit
+
+import numpy as np
+
+from beam_search import weight_vector
+from ctc_model import load_experiment, close_experiment, sentence_logits
+from decode_pool import decode_sentence
+from n_gram_model import NGramModel, add_load_argument, load_in_background
+
+
+PendingRequest = NamedTuple("PendingRequest", [
+    ("request", dict),
+    ("received", float),
+    ("reply", Callable[[dict], None])])
+
+
+def log(*message) -> None:
+    # the standard output may carry the responses
+    print(*message, file=sys.stderr, flush=True)
+
+
+def parse_request(line: str) -> dict:
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a JSON object.")
+    return request
+
+
+def request_options(request: dict, defaults: dict,
+                    vocabulary_size: int) -> dict:
+    """Merge the options of the request with the defaults and check them."""
+    source = request["source"]
+    if isinstance(source, str):
+        source = source.split()
+    if not (isinstance(source, list)
+            and all(isinstance(token, str) for token in source)):
+        raise TypeError("The source must be a string or a list of strings.")
+
+    weights = dict(defaults["weights"])
+    weights.update(request.get("weights", {}))
+    weight_vector(weights)
+
+    beam = int(request.get("beam", defaults["beam"]))
+    if beam < 1:
+        raise ValueError("The beam size must be positive.")
+    if 2 * beam >= vocabulary_size:
+        raise ValueError("Twice the beam size must be smaller than the "
+                         "vocabulary of {} tokens.".format(vocabulary_size))
+
+    blank_threshold = request.get(
+        "blank_threshold", defaults["blank_threshold"])
+    if blank_threshold is not None:
+        if (isinstance(blank_threshold, bool)
+                or not isinstance(blank_threshold, (int, float))
+                or not 0.0 < blank_threshold <= 1.0):
+            raise ValueError("The blank threshold must be in (0, 1].")
+        blank_threshold = float(blank_threshold)
+
+    return {"source": source,
+            "beam": beam,
+            "weights": weights,
+            "blank_threshold": blank_threshold}
+
+
+def error_reply(item: PendingRequest, message: str) -> None:
+    item.reply({"id": item.request.get("id"), "error": message})
+
+
+def process_batch(exp, lm: NGramModel, vocabulary, defaults: dict,
+                  batch: List[PendingRequest], series: str) -> List[float]:
+    """Answer a batch of requests, return their latencies."""
+    # pylint: disable=broad-except
+    valid = []
+
+    for item in batch:
+        try:
+            valid.append((item, request_options(
+                item.request, defaults, len(vocabulary))))
+        except (KeyError, TypeError, ValueError) as exc:
+            error_reply(item, "Invalid request: {}".format(exc))
+
+    if not valid:
+        return []
+
+    try:
+        sentences = sentence_logits(
+            exp, [options["source"] for _, options in valid], series)
+    except Exception as exc:
+        log("The batch of {} requests failed: {!r}".format(len(valid), exc))
+        # run the requests one by one, so that only the failing ones are lost
+        sentences = []
+        for item, options in valid:
+            try:
+                sentences.extend(sentence_logits(
+                    exp, [options["source"]], series))
+            except Exception as exc:
+                error_reply(item, "The model failed: {}".format(exc))
+                sentences.append(None)
+
+    latencies = []
+    for (item, options), sent in zip(valid, sentences):
+        if sent is None:
+            continue
+
+        try:
+            result = decode_sentence(
+                sent.logits, options["beam"], vocabulary, lm,
+                options["weights"],
+                {"blank_threshold": options["blank_threshold"]})
+        except Exception as exc:
+            error_reply(item, "The decoding failed: {}".format(exc))
+            continue
+
+        latency = timeit.default_timer() - item.received
+        latencies.append(latency)
+
+        item.reply({"id": item.request.get("id"),
+                    "output": " ".join(result.tokens),
+                    "latency": round(latency, 4),
+                    "model_time": round(sent.model_time, 4),
+                    "decode_time": round(result.decode_time, 4)})
+
+    return latencies
+
+
+def serve(exp, lm: NGramModel, vocabulary, defaults: dict,
+          requests: queue.Queue, max_batch: int, batch_wait: float,
+          series: str) -> List[float]:
+    """Answer the requests until None is received from the queue.
+
+    After the first request of a batch arrives, the server waits at most
+    `batch_wait` seconds for more requests, up to `max_batch` of them.
+    """
+    latencies = []
+    stopping = False
+
+    while not stopping:
+        first = requests.get()
+        if first is None:
+            break
+
+        batch = [first]
+        deadline = timeit.default_timer() + batch_wait
+
+        while len(batch) < max_batch:
+            timeout = deadline - timeit.default_timer()
+            if timeout <= 0:
+                break
+            try:
+                item = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+
+        latencies.extend(process_batch(
+            exp, lm, vocabulary, defaults, batch, series))
+
+    # answer whatever came after the shutdown
+    while True:
+        try:
+            item = requests.get_nowait()
+        except queue.Empty:
+            break
+        if item is not None:
+            error_reply(item, "The server is shutting down.")
+
+    return latencies
+
+
+def read_stdin(requests: queue.Queue) -> None:
+    lock = threading.Lock()
+
+    def write_response(response: dict) -> None:
+        with lock:
+            sys.stdout.write(json.dumps(response, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        received = timeit.default_timer()
+        try:
+            request = parse_request(line)
+        except ValueError as exc:
+            write_response({"id": None,
+                            "error": "Invalid request: {}".format(exc)})
+            continue
+
+        requests.put(PendingRequest(request, received, write_response))
+
+    requests.put(None)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                         http.server.HTTPServer):
+    daemon_threads = True
+
+
+def http_handler(requests: queue.Queue) -> type:
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            received = timeit.default_timer()
+            length = int(self.headers.get("Content-Length", 0))
+
+            try:
+                request = parse_request(self.rfile.read(length).decode("utf-8"))
+            except ValueError as exc:
+                self.respond(400, {"id": None,
+                                   "error": "Invalid request: {}".format(exc)})
+                return
+
+            response_queue = queue.Queue(maxsize=1)
+            requests.put(PendingRequest(request, received, response_queue.put))
+            response = response_queue.get()
+
+            self.respond(400 if "error" in response else 200, response)
+
+        def respond(self, status: int, response: dict) -> None:
+            body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # pylint: disable=redefined-builtin
+            pass
+
+    return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("config", metavar="INI-FILE",
+                        help="the configuration file of the experiment")
+    parser.add_argument("datasets", metavar="INI-FILE",
+                        help="the configuration file of the experiment")
+    parser.add_argument("--beam", metavar="BEAM_SIZE", type=int, default=10,
+                        help="Default beam size.")
+    parser.add_argument("--kenlm", type=str, required=True,
+                        help="Path to a KenLM model arpa file.")
+    parser.add_argument("--lm-weight", type=float,
+                        help="Default weight of the language model.")
+    parser.add_argument("--null-trail-weight", type=float,
+                        help="Default weight of the null-trailing feature.")
+    parser.add_argument("--nt-ratio-weight", type=float,
+                        help="Default weight of the null-token ratio feature.")
+    parser.add_argument("--blank-threshold", type=float, default=None,
+                        help="Default threshold of the null-only frames.")
+    parser.add_argument("--lm-cache-size", type=int, default=0,
+                        help="Number of LM transitions kept in the cache, "
+                        "zero disables the cache.")
+    parser.add_argument("--lm-cache-persistent", action="store_true",
+                        help="Keep the LM cache across sentences.")
+    add_load_argument(parser)
+    parser.add_argument("--max-batch", type=int, default=16,
+                        help="Maximum number of requests run through the CTC "
+                        "model at once.")
+    parser.add_argument("--batch-wait", type=float, default=0.01,
+                        help="Seconds to wait for more requests to a batch.")
+    parser.add_argument("--source-series", type=str, default="source",
+                        help="Input series of the CTC model.")
+    parser.add_argument("--port", type=int, default=None,
+                        help="Serve HTTP on this port of localhost instead of "
+                        "the standard input and output.")
+    args = parser.parse_args()
+
+    if (args.blank_threshold is not None
+            and not 0.0 < args.blank_threshold <= 1.0):
+        parser.error("The blank threshold must be in (0, 1].")
+
+    weights = {}
+
+    if args.lm_weight:
+        weights['lm_score'] = args.lm_weight
+
+    if args.null_trail_weight:
+        weights['null_trailing'] = args.null_trail_weight
+
+    if args.nt_ratio_weight:
+        weights['null_token_ratio'] = args.nt_ratio_weight
+
+    defaults = {"beam": args.beam,
+                "weights": weights,
+                "blank_threshold": args.blank_threshold}
+
+    t1 = timeit.default_timer()
+    lm_loader = load_in_background(
+        args.kenlm, cache_size=args.lm_cache_size,
+        persistent_cache=args.lm_cache_persistent, load_method=args.lm_load)
+    exp, _, ctc_decoder = load_experiment(args.config, args.datasets)
+    lm = lm_loader.result()
+    t2 = timeit.default_timer()
+    log("Model and LM loaded in {:.1f} s, LM {}".format(
+        t2 - t1, lm.load_stats()))
+
+    requests = queue.Queue()
+
+    def stop(signum, frame):
+        # queue.put must not run inside a signal handler of the thread
+        # which may hold the lock of the queue
+        threading.Thread(target=requests.put, args=(None,)).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    server = None
+    if args.port is not None:
+        server = ThreadingHTTPServer(
+            ("localhost", args.port), http_handler(requests))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log("Serving on http://localhost:{}/".format(args.port))
+    else:
+        threading.Thread(
+            target=read_stdin, args=(requests,), daemon=True).start()
+        log("Reading requests from the standard input")
+
+    try:
+        latencies = serve(exp, lm, ctc_decoder.vocabulary, defaults,
+                          requests, args.max_batch, args.batch_wait,
+                          args.source_series)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        close_experiment(exp)
+
+    if latencies:
+        log("Served {} requests, latency mean {:.3f} s, median {:.3f} s, "
+            "95th percentile {:.3f} s".format(
+                len(latencies), np.mean(latencies),
+                np.percentile(latencies, 50), np.percentile(latencies, 95)))
+
+    if lm.cache_size > 0:
+        log("LM cache:", lm.cache_stats())
+
+
+if __name__ == "__main__":
+    main()
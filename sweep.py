@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Search for the feature weights with the best BLEU on a development set.
+
+The logits are computed only once and stored in a logits store. All the
+weight vectors are then decoded in a pool of processes which read the
+logits from the store and keep their LM cache across the weight vectors.
+"""
+
+# pylint: disable=unused-import, wrong-import-order
+import sys
+
+sys.path.append("./neuralmonkey")
+import neuralmonkey.checkpython
+# pylint: enable=unused-import, wrong-import-order
+
+from typing import Dict, List, Tuple
+import argparse
+import collections
+import itertools
+import multiprocessing
+import os
+
+import numpy as np
+import sacrebleu
+
+from beam_search import FEATURES
+from decode_pool import WORKER, decode_sentence, init_worker, worker_store
+from logits_store import LogitsStore, LogitsStoreWriter
+from n_gram_model import add_load_argument
+
+
+def _decode_chunk(task: Tuple[int, dict, int, int]
+                 ) -> Tuple[int, int, List[List[str]], float]:
+    weights_index, weights, start, end = task
+    store = worker_store()
+
+    outputs = []
+    decode_time = 0.0
+
+    for i in range(start, end):
+        result = decode_sentence(
+            store[i].logits, WORKER["beam_width"], store.vocabulary,
+            WORKER["lm"], weights, WORKER["decode_options"])
+        outputs.append(result.tokens)
+        decode_time += result.decode_time
+
+    return weights_index, start, outputs, decode_time
+
+
+def spm_detokenize(tokens: List[str]) -> str:
+    """Join SentencePiece pieces into text, same as `spm_decode`."""
+    return "".join(tokens).replace("▁", " ").strip()
+
+
+def parse_ranges(ranges: List[str]) -> Dict[str, List[float]]:
+    """Parse the `FEATURE=LOW:HIGH[:STEP]` ranges of the weights."""
+    parsed = collections.OrderedDict()
+
+    for item in ranges:
+        key, _, bounds = item.partition("=")
+        if key not in FEATURES[1:]:
+            raise ValueError("Unknown feature: {}".format(key))
+        parsed[key] = [float(value) for value in bounds.split(":")]
+
+    return parsed
+
+
+def grid_weights(ranges: Dict[str, List[float]]) -> List[dict]:
+    axes = []
+    for key, bounds in ranges.items():
+        if len(bounds) != 3:
+            raise ValueError(
+                "Grid search needs a step for the feature {}.".format(key))
+        low, high, step = bounds
+        axes.append(np.round(np.arange(low, high + step / 2, step), 6))
+
+    return [dict(zip(ranges.keys(), map(float, values)))
+            for values in itertools.product(*axes)]
+
+
+def random_weights(ranges: Dict[str, List[float]], count: int,
+                   seed: int) -> List[dict]:
+    random = np.random.RandomState(seed)
+
+    return [{key: round(float(random.uniform(bounds[0], bounds[1])), 3)
+             for key, bounds in ranges.items()}
+            for _ in range(count)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("config", metavar="INI-FILE", nargs="?",
+                        help="the configuration file of the experiment")
+    parser.add_argument("datasets", metavar="INI-FILE", nargs="?",
+                        help="the configuration file of the experiment")
+    parser.add_argument("--logits-store", type=str, required=True,
+                        help="Store with the logits of the development set, "
+                        "it is created from the INI files if it does not "
+                        "exist.")
+    parser.add_argument("--ref", type=str, required=True,
+                        help="Detokenized references of the development set.")
+    parser.add_argument("--beam", metavar="BEAM_SIZE", type=int, default=10,
+                        help="Beam size.")
+    parser.add_argument("--kenlm", type=str, required=True,
+                        help="Path to a KenLM model arpa file.")
+    parser.add_argument("--range", type=str, action="append", required=True,
+                        metavar="FEATURE=LOW:HIGH[:STEP]", dest="ranges",
+                        help="Range of the weight of the feature, can be "
+                        "repeated.")
+    parser.add_argument("--random", type=int, default=None,
+                        help="Sample this many weight vectors uniformly from "
+                        "the ranges instead of the grid search.")
+    parser.add_argument("--seed", type=int, default=1234,
+                        help="Seed of the random search.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of decoding processes.")
+    parser.add_argument("--chunk-size", type=int, default=100,
+                        help="Number of sentences decoded in one task.")
+    parser.add_argument("--lm-cache-size", type=int, default=100000,
+                        help="Number of LM transitions kept in the cache of "
+                        "every process, each takes about 350 bytes, i.e. "
+                        "35 MB per process by default.")
+    add_load_argument(parser)
+    parser.add_argument("--blank-threshold", type=float, default=None,
+                        help="Expand frames where the null token probability "
+                        "is higher than this only by the null token.")
+    parser.add_argument("--candidate-mass", type=float, default=None,
+                        help="Expand every frame only by the most probable "
+                        "tokens which cover this probability mass together "
+                        "with the null token, at most 2 * beam of them.")
+    parser.add_argument("--lm-bound", type=str, default=None,
+                        choices=["zero", "unigram"],
+                        help="Skip the LM queries of expansions which cannot "
+                        "get into the beam with the LM score bounded by zero "
+                        "(exact) or by the unigram score (approximate).")
+    parser.add_argument("--beam-margin", type=float, default=None,
+                        help="Prune also the hypotheses scoring more than "
+                        "this below the best one, BEAM_SIZE is then the "
+                        "largest beam.")
+    parser.add_argument("--min-beam", type=int, default=1,
+                        help="Smallest beam kept with --beam-margin.")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Path to the table with the results.")
+    parser.add_argument("--best", type=str, default=None,
+                        help="Path to store the best weights as KEY=value.")
+    args = parser.parse_args()
+
+    if (args.blank_threshold is not None
+            and not 0.0 < args.blank_threshold <= 1.0):
+        parser.error("The blank threshold must be in (0, 1].")
+
+    ranges = parse_ranges(args.ranges)
+
+    if args.random is not None:
+        weight_vectors = random_weights(ranges, args.random, args.seed)
+    else:
+        weight_vectors = grid_weights(ranges)
+
+    if not os.path.exists(os.path.join(args.logits_store, "meta.json")):
+        if args.datasets is None:
+            parser.error("The logits store does not exist, the INI files "
+                         "are required to create it.")
+
+        # imports TensorFlow, needed only for creating the store
+        from ctc_model import load_experiment, close_experiment, model_logits
+
+        exp, dataset, ctc_decoder = load_experiment(
+            args.config, args.datasets)
+        writer = LogitsStoreWriter(args.logits_store, ctc_decoder.vocabulary)
+        for sent in model_logits(exp, dataset):
+            writer.write(sent)
+        writer.close()
+        close_experiment(exp)
+
+    store_size = len(LogitsStore(args.logits_store))
+
+    with open(args.ref, encoding="utf-8") as ref_file:
+        references = [line.rstrip("\n") for line in ref_file]
+
+    if len(references) != store_size:
+        raise ValueError("{} references for {} sentences.".format(
+            len(references), store_size))
+
+    print("Decoding {} sentences with {} weight vectors".format(
+        store_size, len(weight_vectors)))
+
+    tasks = [(w, weights, start, min(start + args.chunk_size, store_size))
+             for w, weights in enumerate(weight_vectors)
+             for start in range(0, store_size, args.chunk_size)]
+
+    outputs = [[None] * store_size for _ in weight_vectors]
+    decode_times = [0.0] * len(weight_vectors)
+
+    lm_options = {"cache_size": args.lm_cache_size,
+                  "persistent_cache": True,
+                  "load_method": args.lm_load}
+    decode_options = {"blank_threshold": args.blank_threshold,
+                      "candidate_mass": args.candidate_mass,
+                      "lm_bound": args.lm_bound,
+                      "beam_margin": args.beam_margin,
+                      "min_beam": args.min_beam}
+
+    context = multiprocessing.get_context("forkserver")
+    with context.Pool(args.workers, initializer=init_worker,
+                      initargs=("Decoding", args.kenlm, lm_options,
+                                {"store_path": args.logits_store,
+                                 "beam_width": args.beam,
+                                 "decode_options": decode_options})) as pool:
+        for done, (w, start, chunk_outputs, decode_time) in enumerate(
+                pool.imap_unordered(_decode_chunk, tasks)):
+            outputs[w][start:start + len(chunk_outputs)] = chunk_outputs
+            decode_times[w] += decode_time
+
+            if done % 10 == 0:
+                print("[{}/{}] tasks done".format(done, len(tasks)))
+
+    results = []
+    for weights, sentences, decode_time in zip(
+            weight_vectors, outputs, decode_times):
+        hypotheses = [spm_detokenize(tokens) for tokens in sentences]
+        bleu = sacrebleu.corpus_bleu(hypotheses, [references]).score
+        results.append((weights, bleu, decode_time))
+
+    with open(args.out, "w") as out_file:
+        out_file.write("\t".join(list(ranges.keys()) + ["bleu", "time"]) + "\n")
+        for weights, bleu, decode_time in results:
+            out_file.write("\t".join(
+                ["{:.3f}".format(weights[key]) for key in ranges.keys()]
+                + ["{:.2f}".format(bleu), "{:.3f}".format(decode_time)])
+                           + "\n")
+
+    best_weights, best_bleu, _ = max(results, key=lambda r: r[1])
+    print("Best BLEU {:.2f} with weights {}".format(best_bleu, best_weights))
+
+    if args.best is not None:
+        with open(args.best, "w") as best_file:
+            for key, value in best_weights.items():
+                best_file.write("{}={:.3f}\n".format(key.upper(), value))
+
+
+if __name__ == "__main__":
+    main()
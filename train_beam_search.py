@@ -1,66 +1,149 @@
 #!/usr/bin/env python3
 
-from typing import List
+from typing import TYPE_CHECKING, Any, List, Tuple
 import numpy as np
-import copy
-import pprint as pp
-from scipy.misc import logsumexp
-from scipy.stats import beta
 
-from neuralmonkey.vocabulary import Vocabulary
+if TYPE_CHECKING:
+    from neuralmonkey.vocabulary import Vocabulary
 from n_gram_model import NGramModel
-from hypothesis import Hypothesis, ExpandFunction
+from hypothesis import Hypothesis, PrefixTree, ROOT
 
 
-from beam_search import score_hypothesis, compute_feature, \
-                        log_softmax, expand_null, empty_hypothesis
+from beam_search import FEATURES, feature_matrix, log_softmax, empty_beam, \
+                        expand_beam, candidate_table, score_beam, \
+                        weight_vector
 
-def list_startswith(list1, list2):
-    return all([token1 == token2 for token1, token2 in zip(list1, list2)])
-
-def update_weights(violation_hyp: Hypothesis, target_hyp: Hypothesis, 
-                        weights: dict, states_cnt: int):
-    LEARNING_RATE = 0.0005
-
-    for key in weights.keys():
-        weights[key] += LEARNING_RATE * (compute_feature(key, target_hyp, states_cnt) - 
-                                         compute_feature(key, violation_hyp, states_cnt))
+def tree_startswith(tree: PrefixTree, node: int, target: List,
+                        memo: dict) -> bool:
+    """Check that the output of the node agrees with the target.
 
+    Only the common prefix is compared, i.e. outputs longer than the target
+    are accepted as well. The result is memoized per node, so that every
+    node in the tree is checked only once during the search.
+    """
+    if node == ROOT:
+        return True
 
-def add_expanded_hyp(
-    ctc_table: np.ndarray,
-    weights: dict,
-    row: int,
-    col: int, 
-    candidate_hyp: Hypothesis,
-    parent: (int, int)):
-
-    current_hyp = ctc_table[row, col]
+    if node not in memo:
+        depth = tree.depths[node]
+        memo[node] = (tree_startswith(tree, tree.parents[node], target, memo)
+                        and (depth > len(target)
+                            or tree.tokens[node] == target[depth-1]))
 
-    weights = {
-        "lm_score" : 0.0,
-        "null_trailing" : 0.0,
-        "null_token_ratio" : 0.0
-    }
+    return memo[node]
 
-    if current_hyp:
-        score_current = score_hypothesis(current_hyp[0], weights, 0)
-        score_candidate = score_hypothesis(candidate_hyp, weights, 0)
+LEARNING_RATE = 0.0005
 
-        if score_candidate <= score_current:
-            return
+def hypothesis_features(hyp: Hypothesis, states_cnt: int) -> np.ndarray:
+    return feature_matrix(
+        np.array([hyp.ctc_score]), np.array([hyp.lm_score]),
+        np.array([hyp.tokens_cnt]), np.array([hyp.null_total]),
+        np.array([hyp.null_trailing]), states_cnt)[0]
 
-        candidate_hyp.recombine_with(current_hyp[0])
+def feature_difference(violation_hyp: Hypothesis, target_hyp: Hypothesis,
+                        weights: dict, states_cnt: int) -> dict:
+    difference = (hypothesis_features(target_hyp, states_cnt) -
+                  hypothesis_features(violation_hyp, states_cnt))
+    return {key: float(difference[FEATURES.index(key)])
+            for key in weights.keys()}
 
-    ctc_table[row, col] = (candidate_hyp, parent)
+def update_weights(violation_hyp: Hypothesis, target_hyp: Hypothesis, 
+                        weights: dict, states_cnt: int,
+                        learning_rate: float = LEARNING_RATE):
+    difference = feature_difference(
+        violation_hyp, target_hyp, weights, states_cnt)
 
-def ctc_path(
+    for key in weights.keys():
+        weights[key] += learning_rate * difference[key]
+
+
+class CTCAlignment(object):
+    """Best path of the target through the CTC table.
+
+    Only the target row, the CTC score and the trailing nulls of the cells
+    on the path are kept. They do not depend on the weights, so the
+    alignment of a sentence can be reused in later epochs. Hypotheses are
+    created on request, scoring the target by the LM only as far as the
+    requested frame.
+    """
+
+    def __init__(self, target: List[str], target_indices: np.ndarray,
+                 rows: np.ndarray, ctc_scores: np.ndarray,
+                 null_trailing: np.ndarray) -> None:
+        self.target = target
+        self.target_indices = target_indices
+        self.rows = rows
+        self.ctc_scores = ctc_scores
+        self.null_trailing = null_trailing
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _lm_scores(self, lm: NGramModel, vocabulary: "Vocabulary",
+                   rows: int) -> Tuple[List[float], List[Any]]:
+        lm.set_vocabulary(vocabulary)
+        return lm.score_sequence(self.target_indices[:rows].tolist())
+
+    def _hypothesis(self, tree: PrefixTree, node: int, time: int,
+                    lm_score: float, lm_state: Any) -> Hypothesis:
+        hyp = Hypothesis(tree, node, float(self.ctc_scores[time]), lm_score,
+                         lm_state)
+        hyp.null_total = time - int(self.rows[time])
+        hyp.null_trailing = int(self.null_trailing[time])
+        return hyp
+
+    def hypothesis(self, time: int, lm: NGramModel,
+                   vocabulary: "Vocabulary") -> Hypothesis:
+        """Return the hypothesis on the path after `time` frames."""
+        row = int(self.rows[time])
+        tree = PrefixTree()
+        node = ROOT
+        lm_score = 0.0
+        lm_state = None
+
+        for token, token_lm_score, lm_state in zip(
+                self.target, *self._lm_scores(lm, vocabulary, row)):
+            node = tree.child(node, token)
+            lm_score += token_lm_score
+
+        return self._hypothesis(tree, node, time, lm_score, lm_state)
+
+    def path(self, lm: NGramModel,
+             vocabulary: "Vocabulary") -> List[Hypothesis]:
+        """Return the hypotheses of all cells on the path."""
+        tree = PrefixTree()
+        nodes = [ROOT]
+        lm_scores = [0.0]
+        lm_states = [None]
+
+        for token, token_lm_score, new_lm_state in zip(
+                self.target,
+                *self._lm_scores(lm, vocabulary, int(self.rows[-1]))):
+            nodes.append(tree.child(nodes[-1], token))
+            lm_scores.append(lm_scores[-1] + token_lm_score)
+            lm_states.append(new_lm_state)
+
+        return [self._hypothesis(tree, nodes[row], time, lm_scores[row],
+                                 lm_states[row])
+                for time, row in enumerate(self.rows.tolist())]
+
+
+def align_target(
     target: List,
     log_prob_table: np.ndarray,
-    weights: dict,
-    lm: NGramModel,
-    vocabulary: Vocabulary) -> List[Hypothesis]:
+    vocabulary: "Vocabulary") -> CTCAlignment:
+    """Find the best path of the target through the CTC table.
+
+    Cell (row, time) of the table stands for the hypothesis which emitted
+    the first `row` target tokens in the first `time` frames. Only the CTC
+    scores of the cells and their backpointers are kept in dense arrays,
+    because the LM score depends on the row only.
 
+    A cell with two candidates keeps the token expansion unless the null
+    expansion has a higher score, in which case the scores are summed.
+
+    Returns None if the target cannot be aligned.
+    """
     rows = len(target) + 1
     time_steps = len(log_prob_table)
 
@@ -68,133 +151,158 @@ def ctc_path(
     if time_steps < len(target):
         return None
 
-    ctc_table = np.empty(shape=(rows, time_steps), dtype=tuple)
+    target_indices = np.array(
+        [vocabulary.word_to_index[token] for token in target], dtype=np.int64)
 
-    # fill the starting cell with the empty hypothesis
-    ctc_table[0,0] = (empty_hypothesis(), None)
+    ctc_table = np.full((rows, time_steps), -np.inf)
+    filled = np.zeros((rows, time_steps), dtype=bool)
+    # whether the cell was reached by a token from the previous row
+    from_token = np.zeros((rows, time_steps), dtype=bool)
 
-    for time in range(time_steps-1):
-        null_log_prob = log_prob_table[time, -1]
+    # the starting cell is the empty hypothesis
+    ctc_table[0, 0] = 0.0
+    filled[0, 0] = True
 
+    for time in range(time_steps-1):
         # fill only the space around the diagonal
         min_row = max(0, rows - (time_steps-time))
         max_row = min(time + 1, len(target))
 
-        for row in range(min_row, max_row):
-            hyp = ctc_table[row, time][0]
-            next_token = target[row]
-            next_token_idx = vocabulary.word_to_index[next_token]
-
-            # add eps
-            expanded = expand_null(hyp, null_log_prob)
-            add_expanded_hyp(ctc_table, weights, row, time+1, 
-                candidate_hyp=expanded, parent=(row, time))
+        if min_row >= max_row:
+            continue
+
+        col = time + 1
+        prev_scores = ctc_table[min_row:max_row, time]
+        null_scores = prev_scores + log_prob_table[time, -1]
+        token_scores = prev_scores + log_prob_table[
+            time, target_indices[min_row:max_row]]
+
+        # row min_row gets only the null, row max_row only the token
+        ctc_table[min_row:max_row, col] = null_scores
+        ctc_table[max_row, col] = token_scores[-1]
+        from_token[max_row, col] = True
+        filled[min_row:max_row+1, col] = True
+
+        # the scores are compared as the ctc_score feature
+        null_better = null_scores[1:] / col > token_scores[:-1] / col
+        ctc_table[min_row+1:max_row, col] = np.where(
+            null_better,
+            np.logaddexp(null_scores[1:], token_scores[:-1]),
+            token_scores[:-1])
+        from_token[min_row+1:max_row, col] = ~null_better
 
-            # add next token
-            next_token_score = log_prob_table[time, next_token_idx]
-            expanded = lm.expand_token(hyp, next_token, next_token_score)
-            add_expanded_hyp(ctc_table, weights, row+1, time+1, 
-                                candidate_hyp=expanded, parent=(row, time))
+    # error in data
+    if not filled[rows-1, time_steps-1]:
+        return None
 
     # reconstruct path
-    path = []
-    hyp = ctc_table[rows-1, time_steps-1]
+    path_rows = [rows-1]
+    for time in range(time_steps-1, 0, -1):
+        path_rows.append(path_rows[-1] - int(from_token[path_rows[-1], time]))
+    path_rows.reverse()
 
-    # error in data
-    if hyp is None:
-        return None
+    rows = np.array(path_rows)
+    times = np.arange(time_steps)
 
-    while True:
-        path.append(hyp[0])
-        prev_idx = hyp[1]
+    # the last frame where a token was emitted, the nulls trail after it
+    token_times = np.where(from_token[rows, times] & (times > 0), times, 0)
+    null_trailing = times - np.maximum.accumulate(token_times)
 
-        if prev_idx is None:
-            break
+    return CTCAlignment(target, target_indices, rows,
+                        ctc_table[rows, times], null_trailing)
 
-        hyp = ctc_table[prev_idx]
 
-    path.reverse()
-    return path
+def ctc_path(
+    target: List,
+    log_prob_table: np.ndarray,
+    weights: dict,
+    lm: NGramModel,
+    vocabulary: "Vocabulary") -> List[Hypothesis]:
+    """Return the hypotheses on the best path of the target, see
+    `align_target`, or None if the target cannot be aligned."""
+    alignment = align_target(target, log_prob_table, vocabulary)
+
+    if alignment is None:
+        return None
+    return alignment.path(lm, vocabulary)
 
 
 def train_weights(
         logits_table: np.ndarray,
         beam_width: int,
-        vocabulary: Vocabulary,
+        vocabulary: "Vocabulary",
         target: list,
         weights: dict,
-        lm: NGramModel) -> List[str]:
+        lm: NGramModel,
+        updates: List[dict] = None,
+        alignment: CTCAlignment = None,
+        learning_rate: float = LEARNING_RATE) -> CTCAlignment:
+    """Run the early-update perceptron on one sentence.
+
+    The weights are updated in place. If `updates` is given, the weights
+    are left untouched and the feature differences of the violations are
+    appended to it instead.
+
+    The alignment of the target is computed unless it is given, and it is
+    returned, so that it can be reused when the sentence is trained on
+    again. The target hypothesis is built only at the violation.
+    """
     assert beam_width >= 1
     
     log_prob_table = log_softmax(logits_table)
-    hypotheses = [empty_hypothesis()]
+    lm.start_sentence()
+    lm.set_vocabulary(vocabulary)
+    tree = PrefixTree()
+    beam = empty_beam(tree)
     time_steps = log_prob_table.shape[0]
 
-    target_hyp_path = ctc_path(target, log_prob_table, weights, lm, vocabulary)
+    if alignment is None:
+        alignment = align_target(target, log_prob_table, vocabulary)
 
     # error in data
-    if target_hyp_path is None:
-        return
+    if alignment is None:
+        return None
 
     states_cnt = len(log_prob_table)
+    weight_vec = weight_vector(weights)
+    memo = {}
+
+    candidates_table = candidate_table(log_prob_table[:-1, :-1], beam_width)
 
     for time in range(len(log_prob_table)-1):
         log_probs = log_prob_table[time]
+        candidates = candidates_table[time]
+        new_beam = expand_beam(beam, log_probs[-1], candidates,
+                               log_probs[candidates], vocabulary, lm)
 
-        null_log_prob = log_probs[-1]
-        token_log_probs = log_probs[:-1]
-        new_hypotheses = []
-        str_to_hyp = {}
-
-        for hyp in hypotheses:
-            expanded = expand_null(hyp, null_log_prob)
-            str_to_hyp[" ".join(expanded.tokens)] = (
-                expanded, len(new_hypotheses))
-            new_hypotheses.append(expanded)
-
-        best_tokens = np.argpartition(
-            -token_log_probs, 2 * beam_width)[:2 * beam_width]
-
-        best_scores = token_log_probs[best_tokens]
-
-        for hyp_index, hyp in enumerate(hypotheses):
-            for token_index, score in zip(best_tokens, best_scores):
-                token = vocabulary.index_to_word[token_index]
-                expanded = lm.expand_token(hyp, token, score)
-                score = score_hypothesis(expanded, weights, states_cnt)
-                hyp_str = " ".join(expanded.tokens)
-
-                if hyp_str in str_to_hyp:
-                    orig_hyp, hyp_index = str_to_hyp[hyp_str]
-                    expanded.recombine_with(orig_hyp)
-                    new_hypotheses[hyp_index] = expanded
-                    str_to_hyp[hyp_str] = (expanded, hyp_index)
-                else:
-                    str_to_hyp[hyp_str] = (expanded, len(new_hypotheses))
-                    new_hypotheses.append(expanded)
-
-        target_candidates_indices = [i for i, h in enumerate(new_hypotheses) 
-                                        if list_startswith(target, h.tokens)]
-        new_scores = np.array([score_hypothesis(h, weights, states_cnt) 
-                                for h in new_hypotheses])
-        target_candidates = [new_hypotheses[i] 
-                                for i in target_candidates_indices]
-        target_candidates_tokens_cnt = np.array([len(h.tokens) 
-                                for h in target_candidates])
+        target_candidates_indices = [
+            i for i, node in enumerate(new_beam.nodes.tolist())
+            if tree_startswith(tree, node, target, memo)]
+        new_scores = score_beam(new_beam, weight_vec, states_cnt)
+        target_candidates_tokens_cnt = (
+            new_beam.tokens_cnt[target_candidates_indices])
 
         best_hyp_indices = np.argsort(-new_scores)
-        target_hyp_ranks = np.in1d(best_hyp_indices, target_candidates_indices).nonzero()[0]
+        target_hyp_ranks = np.isin(best_hyp_indices, target_candidates_indices).nonzero()[0]
 
-        hypotheses = [new_hypotheses[i] for i in best_hyp_indices[:beam_width]]
+        beam = new_beam.select(best_hyp_indices[:beam_width])
 
         # hypotheses are out of the beam or no hypotheses can be finished in time
         if (all(target_hyp_ranks >= beam_width) or                                      
             all(target_candidates_tokens_cnt + (time_steps - time) < len(target))):
                 
+                target_hyp = alignment.hypothesis(time+1, lm, vocabulary)
+
                 for i in range(beam_width):
-                    violation_hyp = hypotheses[i]
-                    target_hyp = target_hyp_path[time+1]
+                    violation_hyp = beam.hypothesis(i)
+
+                    if updates is not None:
+                        updates.append(feature_difference(
+                            violation_hyp, target_hyp, weights, states_cnt))
+                    else:
+                        update_weights(violation_hyp, target_hyp, weights,
+                                       states_cnt, learning_rate)
 
-                    update_weights(violation_hyp, target_hyp, weights, states_cnt)
+                return alignment
 
-                return
\ No newline at end of file
+    return alignment
@@ -7,28 +7,111 @@ sys.path.append("./neuralmonkey")
 import neuralmonkey.checkpython
 # pylint: enable=unused-import, wrong-import-order
 
+from typing import Iterable, Iterator, List, Tuple
 import argparse
-import json
-import os
+import itertools
+import multiprocessing
+import timeit
 import numpy as np
 
-from neuralmonkey.config.configuration import Configuration
-from neuralmonkey.experiment import Experiment
-from neuralmonkey.logging import log
-from neuralmonkey.decoders import CTCDecoder
-from neuralmonkey.runners import PlainRunner
-from neuralmonkey.runners.tensor_runner import RepresentationRunner
-from neuralmonkey.dataset import BatchingScheme
+from train_beam_search import train_weights, LEARNING_RATE
+from decode_pool import WORKER, init_worker, worker_store
+from logits_store import LogitsStore, LogitsStoreWriter, SentenceLogits
+from n_gram_model import add_load_argument, load_in_background
+from progress import load_progress, remove_progress, save_progress
+
+
+LR_SCHEDULES = ["constant", "linear", "inverse", "exponential"]
+
+
+def _read_shard(shard: list) -> Iterator[Tuple]:
+    """Yield the logits, the target and the alignment of the sentences of
+    a shard, the logits without the sentences are read from the store."""
+    for index, logits, target, alignment in shard:
+        if logits is None:
+            sent = worker_store()[index]
+            logits, target = sent.logits, sent.target
+        yield logits, target, alignment
+
+
+def _train_shard(task) -> Tuple[dict, list]:
+    """Train on a shard of sentences and return the change of the weights
+    and the alignments of the targets.
+
+    With mini-batch mixing, all sentences are decoded with the same frozen
+    weights. With iterative parameter mixing, the shard is trained on a
+    local copy of the weights, one sentence after another.
+    """
+    weights, shard, mixing, learning_rate = task
+    beam_width = WORKER["beam_width"]
+    vocabulary = WORKER["vocabulary"]
+    lm = WORKER["lm"]
+
+    alignments = []
+    if mixing == "ipm":
+        local_weights = dict(weights)
+        for logits, target, alignment in _read_shard(shard):
+            alignments.append(train_weights(
+                logits, beam_width, vocabulary, target, local_weights, lm,
+                alignment=alignment, learning_rate=learning_rate))
+
+        return ({key: local_weights[key] - weights[key] for key in weights},
+                alignments)
+
+    updates = []
+    for logits, target, alignment in _read_shard(shard):
+        alignments.append(train_weights(
+            logits, beam_width, vocabulary, target, weights, lm,
+            updates=updates, alignment=alignment))
+
+    return ({key: learning_rate * sum(update[key] for update in updates)
+             for key in weights}, alignments)
+
+
+def scheduled_learning_rate(schedule: str, learning_rate: float, decay: float,
+                            epoch: int, epochs: int) -> float:
+    """Return the learning rate of the epoch, counted from zero."""
+    if schedule == "linear":
+        return learning_rate * (epochs - epoch) / epochs
+    if schedule == "inverse":
+        return learning_rate / (1.0 + decay * epoch)
+    if schedule == "exponential":
+        return learning_rate * decay ** epoch
+    return learning_rate
+
+
+def epoch_order(size: int, epoch: int, shuffle: bool, seed: int) -> np.ndarray:
+    """Return the order of the sentences in the epoch.
+
+    The permutation depends only on the seed and the epoch, so that an
+    interrupted epoch is resumed in the same order.
+    """
+    if not shuffle:
+        return np.arange(size)
+    return np.random.RandomState(seed + epoch).permutation(size)
+
+
+def chunks(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def save_checkpoint(path: str, weights: dict) -> None:
+    with open(path, "w") as f:
+        for key, value in weights.items():
+            f.write("{}={:.3f}\n".format(key.upper(), value))
 
-from train_beam_search import train_weights
-from n_gram_model import NGramModel
 
 def main() -> None:
     # pylint: disable=no-member,broad-except
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("config", metavar="INI-FILE",
+    parser.add_argument("config", metavar="INI-FILE", nargs="?",
                         help="the configuration file of the experiment")
-    parser.add_argument("datasets", metavar="INI-FILE",
+    parser.add_argument("datasets", metavar="INI-FILE", nargs="?",
                         help="the configuration file of the experiment")
     parser.add_argument("--beam", metavar="BEAM_SIZE", type=int, default=10,
                         help="Beam size.")
@@ -42,21 +125,80 @@ def main() -> None:
                         help="Default weight of the null-trailing feature.")
     parser.add_argument("--nt-ratio-weight", type=float,
                         help="Default weight of the null-token ratio feature.")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of sentences run through the CTC model "
+                        "at once.")
+    parser.add_argument("--bucket-window", type=int, default=0,
+                        help="Number of sentences sorted by length before "
+                        "batching. Zero keeps the dataset order.")
+    parser.add_argument("--lm-cache-size", type=int, default=0,
+                        help="Number of LM transitions kept in the cache, "
+                        "zero disables the cache.")
+    parser.add_argument("--lm-cache-persistent", action="store_true",
+                        help="Keep the LM cache across sentences.")
+    add_load_argument(parser)
+    parser.add_argument("--logits-store", type=str, default=None,
+                        help="Train on logits from this store instead of "
+                        "running the model.")
+    parser.add_argument("--dump-logits", type=str, default=None,
+                        help="Save the logits to a store at this path.")
+    parser.add_argument("--logits-dtype", type=str, default="float32",
+                        choices=["float16", "float32"],
+                        help="Data type of the dumped logits.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of training processes.")
+    parser.add_argument("--shard-size", type=int, default=10,
+                        help="Number of sentences a training process gets "
+                        "between two merges of the weights. The processes "
+                        "read stored logits themselves, but the logits of "
+                        "the model are sent to them, WORKERS * SHARD_SIZE "
+                        "sentences at once.")
+    parser.add_argument("--mixing", type=str, default="minibatch",
+                        choices=["minibatch", "ipm"],
+                        help="Merge the updates of the training processes as "
+                        "a mini-batch or by iterative parameter mixing.")
+    parser.add_argument("--average", action="store_true",
+                        help="Save the average of the weights after every "
+                        "update instead of the last ones.")
+    parser.add_argument("--frozen-model", type=str, default=None,
+                        help="Load the CTC model exported by export_model.py "
+                        "instead of building the experiment, the only INI "
+                        "file is then the datasets one.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted training from the "
+                        "progress recorded in PREFIX-progress.json.")
+    parser.add_argument("--progress-every", type=int, default=10,
+                        help="Record the progress after this many updates.")
+    parser.add_argument("--epochs", type=int, default=1,
+                        help="Number of passes over the dataset. More than "
+                        "one needs stored logits, see --logits-store and "
+                        "--dump-logits, and a checkpoint is saved after "
+                        "every epoch instead of during the pass.")
+    parser.add_argument("--shuffle", action="store_true",
+                        help="Train on the stored logits in a random order "
+                        "in every epoch. The first epoch with "
+                        "--dump-logits keeps the dataset order.")
+    parser.add_argument("--seed", type=int, default=1234,
+                        help="Seed of the shuffling.")
+    parser.add_argument("--learning-rate", type=float, default=LEARNING_RATE,
+                        help="Learning rate of the first epoch.")
+    parser.add_argument("--lr-schedule", type=str, default="constant",
+                        choices=LR_SCHEDULES,
+                        help="Learning rate of the later epochs: constant, "
+                        "decreasing linearly to the last epoch, divided by "
+                        "1 + DECAY * epoch, or multiplied by DECAY ** epoch.")
+    parser.add_argument("--lr-decay", type=float, default=0.5,
+                        help="DECAY of the inverse and exponential "
+                        "schedules.")
 
     args = parser.parse_args()
 
-    test_datasets = Configuration()
-    test_datasets.add_argument("test_datasets")
-    test_datasets.add_argument("batch_size", cond=lambda x: x > 0)
-    test_datasets.add_argument("variables", cond=lambda x: isinstance(x, list))
+    if args.frozen_model is not None and args.datasets is None:
+        # the only INI file is the datasets one
+        args.datasets, args.config = args.config, None
 
-    test_datasets.load_file(args.datasets)
-    test_datasets.build_model()
-    datasets_model = test_datasets.model
-
-    exp = Experiment(config_path=args.config)
-    exp.build_model()
-    exp.load_variables(datasets_model.variables)
+    if args.logits_store is None and args.datasets is None:
+        parser.error("Either the INI files or --logits-store are required.")
 
     weights = {}
 
@@ -72,62 +214,236 @@ def main() -> None:
     if not weights:
         raise ValueError("No default weights specified, nothing to train.")
 
+    if args.resume and args.dump_logits:
+        parser.error("--resume cannot be used with --dump-logits.")
+
+    if args.resume and args.prefix is None:
+        parser.error("--resume needs the --prefix of the interrupted run.")
+
+    if (args.epochs > 1 and args.logits_store is None
+            and args.dump_logits is None):
+        parser.error("More than one epoch needs --logits-store or "
+                     "--dump-logits.")
+
+    # the averaged weights are the state of the optimizer
+    # not PREFIX.*, which are the checkpoints validated by pipeline.sh
+    progress_path = None
+    if args.prefix is not None:
+        progress_path = args.prefix + "-progress.json"
+    progress = {"epoch": 0,
+                "done": 0,
+                "weights": weights,
+                "weights_sum": {key: 0.0 for key in weights},
+                "updates_cnt": 0}
+
+    if args.resume:
+        progress = load_progress(progress_path) or progress
+        weights = progress["weights"]
+        print("Resuming after {} sentences of epoch {}".format(
+            progress["done"], progress.get("epoch", 0)))
+
+    epoch = progress.get("epoch", 0)
+
+    lm_options = {"cache_size": args.lm_cache_size,
+                  "persistent_cache": args.lm_cache_persistent,
+                  "load_method": args.lm_load}
+
+    lm_loader = None
+    if args.workers == 1:
+        print("Loading language model")
+        lm_loader = load_in_background(args.kenlm, **lm_options)
+
+    exp = None
+    writer = None
+
+    store = None
+    if args.logits_store is not None:
+        store = LogitsStore(args.logits_store)
+        vocabulary = store.vocabulary
+        DATASET_SIZE = len(store)
+    else:
+        # imports TensorFlow, which is not needed for the stored logits
+        from ctc_model import load_experiment, load_frozen, model_logits
+
+        t1 = timeit.default_timer()
+        if args.frozen_model is not None:
+            exp, dataset = load_frozen(args.frozen_model, args.datasets)
+            vocabulary = exp.vocabulary
+        else:
+            exp, dataset, ctc_decoder = load_experiment(
+                args.config, args.datasets)
+            vocabulary = ctc_decoder.vocabulary
+        print("CTC model loaded in {:.1f} s".format(
+            timeit.default_timer() - t1))
+        DATASET_SIZE = dataset.length
+
+        if args.dump_logits is not None:
+            writer = LogitsStoreWriter(
+                args.dump_logits, vocabulary, args.logits_dtype)
+
+    def epoch_sentences(start: int, read_logits: bool = True) -> Iterator:
+        """Yield the sentences of the epoch from `start`.
+
+        Stored sentences come without the logits and the target unless
+        `read_logits` is true, the training processes read them.
+        """
+        nonlocal store, writer
+        if store is None and writer is not None and epoch > 0:
+            # the logits of the later epochs are read from the dump
+            writer.close()
+            writer = None
+            store = LogitsStore(args.dump_logits)
+
+        if store is None:
+            sentences = model_logits(
+                exp, dataset, args.batch_size, args.bucket_window,
+                start=start)
+            if writer is not None:
+                sentences = writer.write_through(sentences)
+            return sentences
+
+        order = epoch_order(len(store), epoch, args.shuffle, args.seed)
+        if not read_logits:
+            return (SentenceLogits(i, None, None, 0.0)
+                    for i in order[start:].tolist())
+        return (store[i] for i in order[start:].tolist())
 
-    ctc_decoder = None
-    for runner in exp.model.runners:
-        if (isinstance(runner, PlainRunner)
-                and isinstance(runner.decoder, CTCDecoder)):
-            ctc_decoder = runner.decoder
-            break
-
-    if ctc_decoder is None:
-        raise ValueError(
-            "Was not able to detect CTC decoder in the configuration.")
-
-    print("Loading language model")
-    lm = NGramModel(args.kenlm)
-    print("LM loaded")
-
-    logits_runner = RepresentationRunner(
-        output_series="logits", encoder=ctc_decoder, attribute="logits")
-    exp.model.runners = [logits_runner]
-
-
-    dataset = datasets_model.test_datasets[0]
-    singleton_batches = dataset.batches(BatchingScheme(1))
-
-    DATASET_SIZE = dataset.length
     CHECKPOINTS = 5
     CHECKPOINT_ITERS = int(DATASET_SIZE / CHECKPOINTS)
 
-    print("{} sentences in the dataset, checkpoint every {} sentences ({} checkpoints in total).".format(
-        DATASET_SIZE, CHECKPOINT_ITERS, CHECKPOINTS))
-
-    for i, sent_dataset in enumerate(singleton_batches):
-        ctc_model_result = exp.run_model(
-            sent_dataset, write_out=False, batch_size=1)
-
-        logits = np.squeeze(ctc_model_result[1]['logits'],
-            axis=1)
-        target = ctc_model_result[2]['target'][0]
-
-        train_weights(logits, args.beam, ctc_decoder.vocabulary,
-            target, weights, lm)
-
-        print("[{}] Weights:".format(i+1),
+    if args.epochs > 1:
+        print("{} sentences in the dataset, {} epochs, checkpoint after "
+              "every epoch.".format(DATASET_SIZE, args.epochs))
+    else:
+        print("{} sentences in the dataset, checkpoint every {} sentences ({} checkpoints in total).".format(
+            DATASET_SIZE, CHECKPOINT_ITERS, CHECKPOINTS))
+
+    weights_sum = progress["weights_sum"]
+    updates_cnt = progress["updates_cnt"]
+
+    # alignments of the targets by the sentence index, for the next epochs
+    alignments = {}
+
+    def record_progress(done: int) -> None:
+        progress.update({"epoch": epoch, "done": done, "weights": weights,
+                         "weights_sum": weights_sum,
+                         "updates_cnt": updates_cnt})
+        if progress_path is not None:
+            save_progress(progress_path, progress)
+
+    def saved_weights() -> dict:
+        if args.average:
+            return {key: value / updates_cnt
+                    for key, value in weights_sum.items()}
+        return weights
+
+    def after_update(first: int, done: int) -> None:
+        # sentences first, ..., done-1 were used in the last update
+        nonlocal updates_cnt
+        updates_cnt += 1
+        for key, value in weights.items():
+            weights_sum[key] += value
+
+        print("[{}] Weights:".format(done),
               ", ".join(
                 ["{}: {:.3f}".format(key, value) for key, value in weights.items()]))
 
-        if i != 0 and (i+1) % CHECKPOINT_ITERS == 0:
-            with open("{}.{}".format(args.prefix, int(i/CHECKPOINT_ITERS)), "w") as f:
-                for key, value in weights.items():
-                    f.write("{}={:.3f}\n".format(key.upper(), value))
-
-            print("\nCheckpoint saved.\n")
-
-
-    for session in exp.config.model.tf_manager.sessions:
-        session.close()
+        for i in range(first, done):
+            if (args.epochs == 1 and i != 0
+                    and (i+1) % CHECKPOINT_ITERS == 0):
+                save_checkpoint("{}.{}".format(
+                    args.prefix, int(i/CHECKPOINT_ITERS)), saved_weights())
+
+                print("\nCheckpoint saved.\n")
+
+        if updates_cnt % args.progress_every == 0:
+            record_progress(done)
+
+    lm = None
+    if lm_loader is not None:
+        lm = lm_loader.result()
+        print("LM", lm.load_stats())
+
+    pool = None
+    if args.workers > 1:
+        print("Starting {} training processes".format(args.workers))
+        context = multiprocessing.get_context("forkserver")
+        pool = context.Pool(
+            args.workers, initializer=init_worker,
+            initargs=("Training", args.kenlm, lm_options,
+                      {"vocabulary": vocabulary, "beam_width": args.beam,
+                       "store_path": args.logits_store or args.dump_logits}))
+
+    done = progress["done"]
+    while epoch < args.epochs:
+        learning_rate = scheduled_learning_rate(
+            args.lr_schedule, args.learning_rate, args.lr_decay, epoch,
+            args.epochs)
+        if args.epochs > 1:
+            print("Epoch {}, learning rate {:g}".format(epoch, learning_rate))
+
+        sentences = epoch_sentences(done, read_logits=pool is None)
+
+        if pool is not None:
+            for chunk in chunks(sentences, args.workers * args.shard_size):
+                shards = list(chunks(chunk, args.shard_size))
+                tasks = [(dict(weights),
+                          [(sent.index, sent.logits, sent.target,
+                            alignments.get(sent.index)) for sent in shard],
+                          args.mixing, learning_rate)
+                         for shard in shards]
+                results = pool.map(_train_shard, tasks)
+
+                for key in weights:
+                    delta = sum(d[key] for d, _ in results)
+                    if args.mixing == "ipm":
+                        delta /= len(results)
+                    weights[key] += delta
+
+                for shard, (_, shard_alignments) in zip(shards, results):
+                    for sent, alignment in zip(shard, shard_alignments):
+                        if alignment is not None and args.epochs > 1:
+                            alignments[sent.index] = alignment
+
+                after_update(done, done + len(chunk))
+                done += len(chunk)
+        else:
+            for i, sent in enumerate(sentences, done):
+                alignment = train_weights(
+                    sent.logits, args.beam, vocabulary, sent.target, weights,
+                    lm, alignment=alignments.get(sent.index),
+                    learning_rate=learning_rate)
+                if alignment is not None and args.epochs > 1:
+                    alignments[sent.index] = alignment
+
+                after_update(i, i + 1)
+                done = i + 1
+
+        if args.epochs > 1:
+            save_checkpoint("{}.{}".format(args.prefix, epoch),
+                            saved_weights())
+            print("\nCheckpoint of epoch {} saved.\n".format(epoch))
+
+        epoch += 1
+        done = 0
+        record_progress(done)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if progress_path is not None:
+        remove_progress(progress_path)
+
+    if writer is not None:
+        writer.close()
+
+    if lm is not None and lm.cache_size > 0:
+        print("LM cache:", lm.cache_stats())
+
+    if exp is not None:
+        from ctc_model import close_experiment
+        close_experiment(exp)
 
 
 if __name__ == "__main__":